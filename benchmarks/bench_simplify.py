@@ -0,0 +1,64 @@
+"""
+Compare the Douglas-Peucker engines of GPolyEncoder.
+
+The adversarial input is a densely sampled, nearly straight trace whose
+jitter decays along the path: every split peels a single point off the
+front, which makes the plain scan quadratic. The random walk is a more
+typical GPS track. The spiral folds back past the ends of every span,
+where the hull engine prunes little and has no better worst case than
+the plain scan. Every engine must produce the same encoding.
+
+    python benchmarks/bench_simplify.py [points]
+"""
+from __future__ import print_function
+import math
+import random
+import sys
+import time
+
+from motionless.gpolyencode import GPolyEncoder, numpy
+
+
+def decaying_zigzag(n):
+    decay = 10.0 ** (-6.0 / n)
+    return [(i * 1E-5, (-1) ** i * 1E-4 * decay ** i) for i in range(n)]
+
+
+def random_walk(n, seed=1):
+    rnd = random.Random(seed)
+    lng, lat = 11.5, 48.1
+    points = []
+    for _ in range(n):
+        lng += rnd.uniform(-1E-4, 1E-4)
+        lat += rnd.uniform(-1E-4, 1E-4)
+        points.append((lng, lat))
+    return points
+
+
+def spiral(n):
+    return [(11.5 + i * 1E-7 * math.cos(i / 20.0), 48.1 + i * 1E-7 * math.sin(i / 20.0))
+            for i in range(n)]
+
+
+def main(n):
+    engines = ['python', 'hull']
+    if numpy is not None:
+        engines.insert(1, 'numpy')
+    for name, points in (('decaying zigzag', decaying_zigzag(n)),
+                         ('random walk', random_walk(n)),
+                         ('spiral', spiral(n))):
+        print('%s, %s points' % (name, n))
+        expected = None
+        for engine in engines:
+            encoder = GPolyEncoder(threshold=1E-6, engine=engine)
+            start = time.time()
+            result = encoder.encode(points)
+            elapsed = time.time() - start
+            if expected is None:
+                expected = result
+            assert result == expected, '%s engine output differs' % engine
+            print('  %-8s %8.3fs' % (engine, elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -22,7 +22,7 @@ gjs = geojson.loads(opener.read().decode('utf-8'))
 
 # Prepare a map and add the points
 gmap = DecoratedMap(size_x=640, size_y=440)
-for feat in gjs.features[:260]:  # in case there are many earthquakes today
+for feat in gjs.features:
     magnitude = feat['properties']['mag']
     lon, lat, _ = feat['geometry']["coordinates"]
     if magnitude > 2:
@@ -36,6 +36,9 @@ for feat in gjs.features[:260]:  # in case there are many earthquakes today
         size = 'mid'
     gmap.add_marker(LatLonMarker(lat, lon, color=color, size=size))
 
+# merge nearby quakes of the same class, in case there are many today
+gmap.cluster_markers(pixels=12)
+
 htmlPage = """
 <html>
 <body>
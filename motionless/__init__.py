@@ -1,13 +1,20 @@
 import base64
+import copy
 import hmac
 import hashlib
 import re
+import string
+import threading
+from array import array
+from collections import OrderedDict
 try:
     from urllib import quote
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import quote, urlparse
-from .gpolyencode import GPolyEncoder
+from .gpolyencode import Coordinates, GPolyEncoder, IncrementalEncoder
+from .gpolyencode import _encode_points
+from . import mercator
 
 """
     motionless is a library that takes the pain out of generating Google Static Map URLs.
@@ -50,6 +57,13 @@ class Color(object):
     def is_valid_color(color):
         return Color.pat.match(color) or color in Color.COLORS
 
+    @staticmethod
+    def shortest(color):
+        """Returns color without a redundant opaque (ff) alpha channel."""
+        if color and len(color) == 10 and color.startswith('0x') and color[8:].lower() == 'ff':
+            return color[:8]
+        return color
+
 class Marker(object):
     SIZES = ['tiny', 'mid', 'small']
     LABELS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
@@ -95,9 +109,359 @@ class LatLonMarker(Marker):
         self.longitude = lon
 
 
+class UrlSigner(object):
+    """
+    Signs URLs for the Premium plan with a client secret. The secret is
+    decoded and the HMAC-SHA1 keyed once; each signature starts from a copy
+    of that state. A signer can be passed as the secret of any number of
+    maps and used from several threads.
+    """
+
+    # the signers of the most recently used secrets, oldest first
+    _cache = OrderedDict()
+    _cache_size = 16
+    _cache_lock = threading.Lock()
+
+    def __init__(self, secret):
+        self._hmac = hmac.new(base64.urlsafe_b64decode(secret),
+                              digestmod=hashlib.sha1)
+
+    @classmethod
+    def for_secret(cls, secret):
+        """
+        Returns a shared signer for secret. Only the signers of the last
+        few secrets are kept.
+        """
+        with cls._cache_lock:
+            signer = cls._cache.pop(secret, None)
+            if signer is None:
+                signer = cls(secret)
+                while len(cls._cache) >= cls._cache_size:
+                    cls._cache.popitem(last=False)
+            cls._cache[secret] = signer
+        return signer
+
+    def sign(self, url):
+        signature = self._hmac.copy()
+        # (normalise URL before signing - fails Google's signature checks otherwise)
+        signature.update(url.replace('%7E', '~').encode('utf-8'))
+        return url + '&signature=' + base64.urlsafe_b64encode(signature.digest()).decode('utf-8')
+
+    def sign_many(self, urls):
+        """Yields each URL of the iterable urls, signed."""
+        sign = self.sign
+        for url in urls:
+            yield sign(url)
+
+
+class StyleSheet(object):
+    """
+    A list of map styles compiled once into its quoted URL fragment. Pass
+    it as the style of any number of maps, of any type, instead of the
+    list itself. The styles must not be changed afterwards.
+
+    Each style is a dict with an optional feature and element (both
+    default to all) and a dict of rules, e.g.
+
+        StyleSheet([{'feature': 'road.highway', 'element': 'geometry',
+                     'rules': {'visibility': 'simplified', 'color': '#c280e9'}}])
+    """
+
+    def __init__(self, styles):
+        self.styles = list(styles)
+        self._fragments = {}
+
+    def fragment(self, canonical=False):
+        """
+        Returns the quoted &style=... parameters. Canonical fragments list
+        each style's rules sorted.
+        """
+        fragment = self._fragments.get(canonical)
+        if fragment is None:
+            parts = []
+            for style_map in self.styles:
+                parts.append("&style=feature:%s|element:%s|" % (
+                    style_map.get('feature', 'all'),
+                    style_map.get('element', 'all')))
+                rules = style_map['rules'].items()
+                if canonical:
+                    rules = sorted(rules)
+                for prop, rule in rules:
+                    parts.append("%s:%s|" % (prop, str(rule).replace('#', '0x')))
+            fragment = self._fragments[canonical] = _escape(''.join(parts))
+        return fragment
+
+
+def _as_doubles(values):
+    """
+    Returns values as an indexable sequence of floats, sharing memory with
+    values whenever it exposes float64s (or raw bytes) via the buffer
+    protocol, as array('d'), numpy arrays and mmap objects do.
+    """
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return array('d', values)
+    if view.ndim != 1:
+        raise ValueError("Coordinate buffers must be one dimensional")
+    if view.format == 'd':
+        return view
+    if view.format in ('B', 'b', 'c') and view.nbytes % 8 == 0:
+        return view.cast('B').cast('d')
+    return array('d', view.tolist())
+
+
+class Path(object):
+    """
+    The vertices of a DecoratedMap path. Coordinates are kept as float64
+    arrays: points added one at a time go into an owned array('d'), bulk
+    additions keep a reference to the caller's buffer instead of copying.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._tail = None
+        self._len = 0
+        self.contains_addresses = False
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, tuple):
+                for lat, lon in zip(chunk[0], chunk[1]):
+                    yield "%s,%s" % (lat, lon)
+            else:
+                yield chunk
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("path index out of range")
+        for chunk in self._chunks:
+            if isinstance(chunk, tuple):
+                if index < len(chunk[0]):
+                    return "%s,%s" % (chunk[0][index], chunk[1][index])
+                index -= len(chunk[0])
+            elif index == 0:
+                return chunk
+            else:
+                index -= 1
+
+    def add_latlon(self, lat, lon):
+        if self._tail is None:
+            self._tail = (array('d'), array('d'))
+            self._chunks.append(self._tail)
+        self._tail[0].append(float(lat))
+        self._tail[1].append(float(lon))
+        self._len += 1
+
+    def add_latlons(self, lats, lons):
+        lats = _as_doubles(lats)
+        lons = _as_doubles(lons)
+        if len(lats) != len(lons):
+            raise ValueError(
+                "Got %s latitudes but %s longitudes" % (len(lats), len(lons)))
+        if len(lats):
+            self._chunks.append((lats, lons))
+            self._tail = None
+            self._len += len(lats)
+
+    def add_buffer(self, buf):
+        coords = _as_doubles(buf)
+        if len(coords) % 2:
+            raise ValueError(
+                "Interleaved coordinate buffers need an even number of values")
+        self.add_latlons(coords[0::2], coords[1::2])
+
+    def add_address(self, address):
+        self._add_quoted(quote(address))
+
+    def _add_quoted(self, location):
+        self._chunks.append(location)
+        self._tail = None
+        self._len += 1
+        self.contains_addresses = True
+
+    def coordinates(self, start=0):
+        """
+        Returns the path from index start on as Coordinates of (lon, lat)
+        pairs ready for GPolyEncoder. A path built by a single bulk
+        addition is returned without copying.
+        """
+        if self.contains_addresses:
+            raise ValueError("Paths containing addresses cannot be encoded")
+        if start == 0 and len(self._chunks) == 1:
+            lats, lons = self._chunks[0]
+            return Coordinates(lons, lats)
+        lats = array('d')
+        lons = array('d')
+        for chunk_lats, chunk_lons in self._chunks:
+            if start >= len(chunk_lats):
+                start -= len(chunk_lats)
+                continue
+            lats.extend(chunk_lats[start:])
+            lons.extend(chunk_lons[start:])
+            start = 0
+        return Coordinates(lons, lats)
+
+
+def _format_coordinate(value, precision):
+    text = '%.*f' % (precision, float(value))
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return text
+
+
+def _parse_location(location):
+    """Returns the lat, lon of a "lat,lon" location, or None for an address."""
+    # quoted addresses have their commas escaped
+    parts = location.split(',')
+    if len(parts) == 2:
+        try:
+            return float(parts[0]), float(parts[1])
+        except ValueError:
+            pass
+    return None
+
+
+def _point_text(lat, lon):
+    """The shortest "lat,lon" text of float coordinates: 2.0 is written 2."""
+    text = "%r,%r" % (lat, lon)
+    # a float's repr only has ".0" at the end of an integral value
+    text = text.replace('.0,', ',')
+    if text.endswith('.0'):
+        text = text[:-2]
+    return text
+
+
+def _compact_location(location, precision):
+    """Rounds a "lat,lon" location; leaves addresses as they are."""
+    point = _parse_location(location)
+    if point is None:
+        return location
+    return '%s,%s' % (_format_coordinate(point[0], precision),
+                      _format_coordinate(point[1], precision))
+
+
+class MarkerSet(object):
+    """
+    Markers kept by column: float64 latitudes and longitudes plus the index
+    of each marker's style in styles. A style is validated once, the first
+    time it is used, however many markers share it.
+    """
+
+    def __init__(self):
+        self.lats = array('d')
+        self.lons = array('d')
+        self.style_ids = array('I')
+        self.styles = []
+        self._style_ids = {}
+
+    def __len__(self):
+        return len(self.lats)
+
+    def style_id(self, size=None, color=None, label=None, icon_url=None):
+        """Returns the index of a style in styles, adding it if new."""
+        key = (size, color, label, icon_url)
+        style_id = self._style_ids.get(key)
+        if style_id is None:
+            marker = Marker(size, color, label, icon_url)
+            style_id = self._style_ids[key] = self._add_style(
+                (marker.size, marker.color, marker.label, marker.icon_url))
+        return style_id
+
+    def _add_style(self, style):
+        """Returns the index of a validated style tuple, adding it if new."""
+        style_id = self._style_ids.get(style)
+        if style_id is None:
+            style_id = self._style_ids[style] = len(self.styles)
+            self.styles.append(style)
+        return style_id
+
+    def add(self, lat, lon, size=None, color=None, label=None, icon_url=None):
+        self.lats.append(float(lat))
+        self.lons.append(float(lon))
+        self.style_ids.append(self.style_id(size, color, label, icon_url))
+
+    def add_many(self, lats, lons, size=None, color=None, label=None, icon_url=None):
+        """Adds one marker per lat, lon pair, all of the same style."""
+        lats = _as_doubles(lats)
+        lons = _as_doubles(lons)
+        if len(lats) != len(lons):
+            raise ValueError(
+                "Got %s latitudes but %s longitudes" % (len(lats), len(lons)))
+        style_id = self.style_id(size, color, label, icon_url)
+        _extend_doubles(self.lats, lats)
+        _extend_doubles(self.lons, lons)
+        self.style_ids.extend(array('I', [style_id]) * len(lats))
+
+    def compacted(self, precision):
+        """
+        Returns a copy with coordinates rounded to precision decimal
+        places, colors in their shortest form and repeated locations of a
+        style dropped.
+        """
+        compacted = MarkerSet()
+        seen = set()
+        for lat, lon, style_id in zip(self.lats, self.lons, self.style_ids):
+            size, color, label, icon_url = self.styles[style_id]
+            style = (size, Color.shortest(color), label, icon_url)
+            lat = round(lat, precision)
+            lon = round(lon, precision)
+            if (style, lat, lon) not in seen:
+                seen.add((style, lat, lon))
+                compacted._add_styled(style, [lat], [lon])
+        return compacted
+
+    def _add_styled(self, style, lats, lons):
+        """Adds markers of an already validated style tuple."""
+        style_id = self._add_style(style)
+        self.lats.extend(lats)
+        self.lons.extend(lons)
+        self.style_ids.extend(array('I', [style_id]) * len(lats))
+
+    def groups(self):
+        """Returns the "lat,lon" locations of each style, by style index."""
+        if len(self.styles) == 1:
+            return [[_point_text(lat, lon) for lat, lon in zip(self.lats, self.lons)]]
+        groups = [[] for _ in self.styles]
+        appenders = [group.append for group in groups]
+        for lat, lon, style_id in zip(self.lats, self.lons, self.style_ids):
+            appenders[style_id](_point_text(lat, lon))
+        return groups
+
+
+def _extend_doubles(target, values):
+    if isinstance(values, memoryview) and values.contiguous:
+        target.frombytes(values.cast('B'))
+    else:
+        target.extend(values)
+
+
 class Map(object):
     MAX_URL_LEN = 8192  # https://developers.google.com/maps/documentation/static-maps/intro#url-size-restriction
 
+    # the last generated URL; dropped whenever a public attribute is set or
+    # an add_* method runs
+    _url = None
+
+    # style compiled into a StyleSheet, when given as a list
+    _sheet = None
+
+    # see DecoratedMap
+    canonical = False
+
+    # maps fitted to their content keep it this many pixels from their
+    # edges, so markers drawn around a point are not cut off, and zoom in
+    # no further than FIT_MAX_ZOOM on a single point
+    FIT_PADDING = 20
+    FIT_MAX_ZOOM = 18
+
     def __init__(self, size_x, size_y, maptype, zoom=None, scale=1, key=None, language='en', style=None, clientid=None, secret=None, channel=None):
         if key is not None and clientid is not None:
             raise ValueError('Only one of key and clientid may be passed')
@@ -124,29 +488,134 @@ class Map(object):
     def __str__(self):
         return self.generate_url()
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self._url = None
+            if name == 'style':
+                self._sheet = None
+
+    def _changed(self):
+        self._url = None
+
+    def generate_url(self):
+        """
+        Returns the URL for the map, reusing the last one unless the map
+        changed since. Changes made by mutating attributes in place (say
+        dmap.markers.append) are not noticed; use the add_* methods.
+        """
+        url = self._url
+        if url is None:
+            url = self._url = self._generate_url()
+        return url
+
+    def _generate_url(self):
+        url = self._build_url()
+        self._check_url(url)
+        return url
+
+    def _build_url(self):
+        return self._assemble(self._quoted_prefix(), self._quoted_suffix())
+
+    def compact(self, precision=6):
+        """
+        Rounds coordinates to precision decimal places (6 is about 10cm),
+        drops repeated locations and writes colors in their shortest form.
+        Returns the number of characters this took off the URL.
+        """
+        before = len(self._build_url())
+        self._compact(precision)
+        self._changed()
+        return before - len(self._build_url())
+
+    def _compact(self, precision):
+        raise NotImplementedError
+
+    def _query_prefix(self, query):
+        """Adds the parameters before the per-map part to query."""
+        raise NotImplementedError
+
+    def _query_suffix(self, query):
+        """Adds the map type's own parameters after the per-map part to query."""
+        raise NotImplementedError
+
+    def _quoted_prefix(self):
+        query = _Query()
+        self._query_prefix(query)
+        # the query string starts without a separator
+        return query.text()[1:]
+
+    def _quoted_suffix(self):
+        """The whole query after the per-map part: styles and channel follow."""
+        query = _Query()
+        self._query_suffix(query)
+        sheet = self._get_style_sheet()
+        if sheet is not None:
+            query.append(sheet.fragment(self.canonical))
+        if self.channel:
+            query.add('channel', self.channel)
+        return query.text()
+
+    def _get_style_sheet(self):
+        if not self.style:
+            return None
+        if isinstance(self.style, StyleSheet):
+            return self.style
+        if self._sheet is None:
+            self._sheet = StyleSheet(self.style)
+        return self._sheet
+
+    def _assemble(self, prefix, suffix):
+        """
+        Builds the URL, unchecked, from the already quoted static prefix
+        and suffix of the query and this map's own part.
+        """
+        raise NotImplementedError
+
+    def _set_record(self, **fields):
+        """Replaces the per-map part with fields (see MapTemplate)."""
+        raise NotImplementedError
+
+    def _fit(self, box):
+        """
+        Returns the center, as "lat,lon" text, and the zoom of the map
+        that shows box (see mercator.bounds); the map's own zoom is kept.
+        """
+        lat, lon, zoom = mercator.fit_bounds(
+            *box, width=self.size_x, height=self.size_y,
+            max_zoom=self.FIT_MAX_ZOOM, padding=self.FIT_PADDING)
+        if self.zoom:
+            zoom = self.zoom
+        places = mercator.decimals(zoom)
+        return "%s,%s" % (_format_coordinate(lat, places),
+                          _format_coordinate(lon, places)), zoom
+
+    def _url_for(self, prefix, body, suffix):
+        return self.base_url + self._sign(self.url_path + prefix + body + suffix)
+
     def _get_sensor(self):
         if self.sensor:
             return 'true'
         else:
             return 'false'
 
-    def _get_key(self):
+    def _add_key(self, query):
         if self.key:
-            return ''.join(['key=', self.key, '&'])
+            query.add('key', self.key)
         elif self.clientid:
-            return ''.join(['client=', self.clientid, '&'])
-        else:
-            return ''
+            query.add('client', self.clientid)
 
     def _sign(self, url):
         if self.secret:
-            decoded_key = base64.urlsafe_b64decode(self.secret)
-            # (normalise URL before signing - fails Google's signature checks otherwise)
-            signature = hmac.new(decoded_key, url.replace('%7E', '~').encode('utf-8'), hashlib.sha1)
-            return url + '&signature=' + base64.urlsafe_b64encode(signature.digest()).decode('utf-8')
+            return self._get_signer().sign(url)
         else:
             return url
 
+    def _get_signer(self):
+        if isinstance(self.secret, UrlSigner):
+            return self.secret
+        return UrlSigner.for_secret(self.secret)
+
     def _check_url(self, url):
         if len(url) > Map.MAX_URL_LEN:
             raise ValueError(
@@ -160,6 +629,9 @@ class CenterMap(Map):
                  size_y=400, maptype='roadmap', scale=1, key=None, style=None, language='en', clientid=None, secret=None, channel=None):
         Map.__init__(self, size_x=size_x, size_y=size_y, maptype=maptype,
                      zoom=zoom, scale=scale, key=key, style=style, language=language, clientid=clientid, secret=secret, channel=channel)
+        self._set_record(address=address, lat=lat, lon=lon)
+
+    def _set_record(self, address=None, lat=None, lon=None):
         if address:
             self.center = quote(address)
         elif lat and lon:
@@ -167,58 +639,100 @@ class CenterMap(Map):
         else:
             self.center = "1600 Amphitheatre Parkway Mountain View, CA"
 
-    def generate_url(self):
-        query = "%smaptype=%s&format=%s&scale=%s&center=%s&zoom=%s&size=%sx%s&sensor=%s&language=%s" % (
-            self._get_key(),
-            self.maptype,
-            self.format,
-            self.scale,
-            self.center,
-            self.zoom,
-            self.size_x,
-            self.size_y,
-            self._get_sensor(),
-            self.language)
-        if self.channel:
-            query += '&channel=%s' % (self.channel)
+    def _compact(self, precision):
+        self.center = _compact_location(self.center, precision)
 
-        url = self.base_url + self._sign(self.url_path + quote(query, safe='/&=%'))
+    def _query_prefix(self, query):
+        self._add_key(query)
+        query.add('maptype', self.maptype)
+        query.add('format', self.format)
+        query.add('scale', self.scale)
+        query.add_quoted('center', '')
 
-        self._check_url(url)
-        return url
+    def _query_suffix(self, query):
+        query.add('zoom', self.zoom)
+        query.add('size', '%sx%s' % (self.size_x, self.size_y))
+        query.add('sensor', self._get_sensor())
+        query.add('language', self.language)
+
+    def _assemble(self, prefix, suffix):
+        return self._url_for(prefix, _escape(self.center), suffix)
 
 
 class VisibleMap(Map):
 
-    def __init__(self, size_x=400, size_y=400, maptype='roadmap', scale=1, key=None, style=None, language='en', clientid=None, secret=None, channel=None):
+    def __init__(self, size_x=400, size_y=400, maptype='roadmap', scale=1, key=None, style=None, language='en', clientid=None, secret=None, channel=None, auto_fit=False):
         Map.__init__(self, size_x=size_x, size_y=size_y, maptype=maptype, scale=scale, key=key, style=style, language=language, clientid=clientid, secret=secret, channel=channel)
         self.locations = []
+        # when set, a center and zoom fitted to the locations are sent
+        # instead of the locations themselves, unless there are addresses
+        self.auto_fit = auto_fit
 
     def add_address(self, address):
         self.locations.append(quote(address))
+        self._changed()
 
     def add_latlon(self, lat, lon):
-        self.locations.append("%s,%s" % (quote(lat), quote(lon)))
-
-    def generate_url(self):
-        query = "%smaptype=%s&format=%s&scale=%s&size=%sx%s&sensor=%s&visible=%s&language=%s" % (
-            self._get_key(),
-            self.maptype,
-            self.format,
-            self.scale,
-            self.size_x,
-            self.size_y,
-            self._get_sensor(),
-            "|".join(self.locations),
-            self.language)
-        if self.channel:
-            query += '&channel=%s' % (self.channel)
-
-        url = self.base_url + self._sign(self.url_path + quote(query, safe='/&=%'))
+        self.locations.append("%s,%s" % (quote(str(lat)), quote(str(lon))))
+        self._changed()
 
-        self._check_url(url)
-
-        return url
+    def _set_record(self, locations=()):
+        self.locations = []
+        for location in locations:
+            if isinstance(location, tuple):
+                self.add_latlon(*location)
+            else:
+                self.add_address(location)
+
+    def _compact(self, precision):
+        locations = []
+        seen = set()
+        for location in self.locations:
+            location = _compact_location(location, precision)
+            if location not in seen:
+                seen.add(location)
+                locations.append(location)
+        self.locations = locations
+
+    def _query_prefix(self, query):
+        self._add_key(query)
+        query.add('maptype', self.maptype)
+        query.add('format', self.format)
+        query.add('scale', self.scale)
+        query.add('size', '%sx%s' % (self.size_x, self.size_y))
+        query.add('sensor', self._get_sensor())
+
+    def _query_suffix(self, query):
+        query.add('language', self.language)
+
+    def _assemble(self, prefix, suffix):
+        if self.auto_fit:
+            box = self._bounds()
+            if box is not None:
+                center, zoom = self._fit(box)
+                query = _Query()
+                query.add('center', center)
+                query.add('zoom', zoom)
+                return self._url_for(prefix, query.text(), suffix)
+        return self._url_for(
+            prefix, "&visible=" + _escape("|".join(self.locations)), suffix)
+
+    def _bounds(self):
+        """
+        Returns the box (see mercator.bounds) around the locations, or None
+        if there are none or any is an address.
+        """
+        lats = []
+        lons = []
+        for location in self.locations:
+            point = _parse_location(location)
+            if point is None:
+                return None
+            lats.append(point[0])
+            lons.append(point[1])
+        if not lats:
+            return None
+        return mercator.bounds(lats, lons)
 
 
 class DecoratedMap(Map):
@@ -228,24 +742,74 @@ class DecoratedMap(Map):
     def __init__(self, lat=None, lon=None, zoom=None, size_x=400, size_y=400,
                  maptype='roadmap', scale=1, region=False, fillcolor='green',
                  pathweight=None, pathcolor=None, key=None, style=None,
-                 simplify_threshold_meters=1.11111, language='en', clientid=None, secret=None, channel=None):
+                 simplify_threshold_meters=1.11111, language='en', clientid=None, secret=None, channel=None,
+                 auto_simplify=False, incremental_window=None,
+                 simplify_max_points=None, simplify_min_area_sq_meters=None,
+                 canonical=False, auto_fit=False):
         Map.__init__(self, size_x=size_x, size_y=size_y, maptype=maptype,
                      zoom=zoom, scale=scale, key=key, style=style, language=language, clientid=clientid, secret=secret, channel=channel)
         self.markers = []
+        self._marker_set = MarkerSet()
         self.fillcolor = fillcolor
         self.pathweight = pathweight
         self.pathcolor = pathcolor
         self.region = region
-        self.path = []
-        self.contains_addresses = False
+        self.path = Path()
         if simplify_threshold_meters is None:
             self.simplify_threshold = 0
         else:
             self.simplify_threshold = simplify_threshold_meters / DecoratedMap.METERS_PER_DEGREE
+        # when set, simplify_threshold is only a floor: the path is
+        # simplified just enough for the URL to fit in MAX_URL_LEN
+        self.auto_simplify = auto_simplify
+        # when set, the path is encoded by an IncrementalEncoder that only
+        # re-simplifies the last incremental_window points, which suits
+        # maps regenerated as a live track grows
+        self.incremental_window = incremental_window
+        self._incremental = None
+        # either of these simplifies with Visvalingam-Whyatt instead of
+        # Douglas-Peucker, for a predictable number of path points
+        self.simplify_max_points = simplify_max_points
+        if simplify_min_area_sq_meters is None:
+            self.simplify_min_area = None
+        else:
+            self.simplify_min_area = simplify_min_area_sq_meters / DecoratedMap.METERS_PER_DEGREE ** 2
+        # when set, marker groups, their locations and style rules are
+        # sorted, so maps that only differ in the order things were added
+        # give byte-identical URLs
+        self.canonical = canonical
+        # when set and there is no center, a center (and, without a zoom,
+        # a zoom) fitted to the markers and path are sent rather than left
+        # to Google, unless some of them are addresses
+        self.auto_fit = auto_fit
+        if lat and lon:
+            self.center = "%s,%s" % (lat, lon)
+        else:
+            self.center = None
+
+    def __setattr__(self, name, value):
+        Map.__setattr__(self, name, value)
+        if name in ('markers', '_marker_set', 'path'):
+            # replaced wholesale; recount on the next estimate
+            self._lengths = None
+        if name in ('path', 'simplify_threshold', 'incremental_window'):
+            # the incremental encoding no longer matches; start over
+            self._incremental = None
+
+    def _set_record(self, lat=None, lon=None, zoom=None, markers=(), path=()):
         if lat and lon:
             self.center = "%s,%s" % (lat, lon)
         else:
             self.center = None
+        if zoom is not None:
+            self.zoom = zoom
+        self.markers = []
+        self._marker_set = MarkerSet()
+        for marker in markers:
+            self.add_marker(marker)
+        self.path = Path()
+        for point in path:
+            self.add_path_latlon(*point)
 
     def check_parameters(self):
         if self.region and len(self.path) < 2:
@@ -256,7 +820,7 @@ class DecoratedMap(Map):
             raise ValueError(
                 "If region enabled, first and last path entry must be identical")
 
-        if len(self.path) == 0 and len(self.markers) == 0:
+        if len(self.path) == 0 and len(self.markers) == 0 and len(self._marker_set) == 0:
             raise ValueError("Must specify points in path or markers")
 
         if not Color.is_valid_color(self.fillcolor):
@@ -269,112 +833,749 @@ class DecoratedMap(Map):
                 "%s is not a valid path color. Must be 24 or 32 bit value or one of %s" %
                 (self.pathcolor, Color.COLORS))
 
-    def _generate_markers(self):
-        styles = set()
+    def _add_markers(self, query):
+        # markers are grouped by style in order of first appearance (those
+        # added with add_markers after those added one by one), so the same map
+        # always gives the same URL; canonical maps also sort the groups
+        # and their locations
+        styles = []
         data = {}
-        ret = []
-        # build list of unique styles
-        for marker in self.markers:
-            styles.add((marker.size, marker.color, marker.label, marker.icon_url))
-        # setup styles/location dict
-        for style in styles:
-            data[style] = []
-        # populate styles/location dict
         for marker in self.markers:
-            if isinstance(marker, AddressMarker):
-                data[(marker.size, marker.color, marker.label, marker.icon_url)
-                     ].append(quote(marker.address))
+            style = (marker.size, marker.color, marker.label, marker.icon_url)
+            locations = data.get(style)
+            if locations is None:
+                locations = data[style] = []
+                styles.append(style)
             if isinstance(marker, LatLonMarker):
-                location = "%s,%s" % (marker.latitude, marker.longitude)
-                data[(marker.size, marker.color, marker.label, marker.icon_url)
-                     ].append(location)
+                locations.append("%s,%s" % (marker.latitude, marker.longitude))
+            elif isinstance(marker, AddressMarker):
+                locations.append(quote(marker.address))
+        marker_set = self._marker_set
+        if len(marker_set):
+            for style, group in zip(marker_set.styles, marker_set.groups()):
+                if not group:
+                    continue
+                locations = data.get(style)
+                if locations is None:
+                    data[style] = group
+                    styles.append(style)
+                else:
+                    locations.extend(group)
+        if self.canonical:
+            styles.sort(key=_style_key)
         # build markers entries for URL
-        for style in data:
+        for style in styles:
             locations = data[style]
-            parts = []
-            parts.append("markers=")
-            if style[0]:
-                parts.append("size:%s" % style[0])
-            if style[1]:
-                parts.append("color:%s" % style[1])
-            if style[2]:
-                parts.append("label:%s" % style[2])
-            if style[3]:
-                parts.append("icon:%s" % style[3])
-            for location in locations:
-                parts.append(location)
-            ret.append("|".join(parts))
-        return "&".join(ret)
+            if self.canonical:
+                locations.sort()
+            query.add('markers', "|".join([''] + _style_parts(style) + locations))
+
+    def _compact(self, precision):
+        if self.center:
+            self.center = _compact_location(self.center, precision)
+        self.pathcolor = Color.shortest(self.pathcolor)
+        self.fillcolor = Color.shortest(self.fillcolor)
+        # markers are copied rather than changed, as they may be shared
+        markers = []
+        seen = set()
+        for marker in self.markers:
+            marker = copy.copy(marker)
+            marker.color = Color.shortest(marker.color)
+            if isinstance(marker, LatLonMarker):
+                marker.latitude = _format_coordinate(marker.latitude, precision)
+                marker.longitude = _format_coordinate(marker.longitude, precision)
+                location = (marker.latitude, marker.longitude)
+            else:
+                location = marker.address
+            key = (marker.size, marker.color, marker.label, marker.icon_url, location)
+            if key not in seen:
+                seen.add(key)
+                markers.append(marker)
+        self.markers = markers
+        self._marker_set = self._marker_set.compacted(precision)
+
+    @property
+    def contains_addresses(self):
+        return self.path.contains_addresses
 
     def _polyencode(self):
+        if self.incremental_window:
+            return self._incremental_polyencode()
+        encoder = GPolyEncoder(threshold=self.simplify_threshold,
+                               max_points=self.simplify_max_points,
+                               min_area=self.simplify_min_area)
+        return encoder.encode(self.path.coordinates(), levels=False)['points']
+
+    def _incremental_polyencode(self):
+        encoder = self._incremental
+        if encoder is None or encoder.count > len(self.path):
+            encoder = self._incremental = IncrementalEncoder(
+                threshold=self.simplify_threshold,
+                window=self.incremental_window)
+        encoder.extend(self.path.coordinates(encoder.count))
+        return encoder.points
+
+    def _fit_polyencode(self, budget):
+        """
+        Returns the quoted encoding of the path for the smallest threshold
+        (no lower than simplify_threshold) whose encoding is at most budget
+        characters long. Douglas-Peucker runs once; candidate thresholds are
+        tested against the recorded significance of each point.
+        """
         encoder = GPolyEncoder(threshold=self.simplify_threshold)
-        points = []
-        for point in self.path:
-            tokens = point.split(',')
-            points.append((float(tokens[1]), float(tokens[0])))
-        return encoder.encode(points)['points']
+        points = self.path.coordinates()
+        significance = encoder.significance(points)
+        thresholds = [self.simplify_threshold] + sorted(
+            set(d for d in significance.values() if d > self.simplify_threshold))
+
+        def encoded(i):
+            return _escape(encoder.encode_significant(
+                points, significance, thresholds[i], levels=False)['points'])
+
+        # encoded length shrinks as the threshold grows
+        lo = 0
+        hi = len(thresholds) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if len(encoded(mid)) <= budget:
+                hi = mid
+            else:
+                lo = mid + 1
+        return encoded(lo)
+
+    def estimated_length(self):
+        """
+        Returns the length the URL will have, signature included, without
+        building or signing it. Counts are kept up as content is added
+        through the add_* methods, so this is cheap. It is exact except for
+        coordinate paths, where it is the length of the unsimplified
+        encoding, which simplification only shortens, and for auto_fit
+        maps without a center, where the longest fitted center and zoom
+        are counted.
+        """
+        lengths = self._url_lengths()
+        length = (len(self.base_url) + len(self.url_path) +
+                  len(self._quoted_prefix()) + len(self._quoted_suffix()))
+        if self.center:
+            length += len("&center=") + _quoted_length(self.center)
+        elif self.auto_fit:
+            # -85.xxx,-179.xxx with the places of the closest fitted zoom,
+            # or of the map's own zoom when that is closer
+            length += (len("&center=-85.%2C-179.") +
+                       2 * mercator.decimals(max(self.zoom or 0, self.FIT_MAX_ZOOM)))
+        if self.zoom:
+            length += len("&zoom=%s" % self.zoom)
+        elif self.auto_fit and not self.center:
+            length += len("&zoom=%s" % self.FIT_MAX_ZOOM)
+        for group in lengths.groups.values():
+            length += 1 + group
+        if len(self.path) > 0:
+            length += len("&path=") + len(self._path_style())
+            if self.contains_addresses:
+                length += _quoted_length("|".join(self.path))
+            else:
+                length += len("enc%3A") + lengths.path
+        if self.secret:
+            # a base64 HMAC-SHA1
+            length += len("&signature=") + 28
+        return length
+
+    def remaining_budget(self):
+        """Returns how many characters can still be added to the URL."""
+        return Map.MAX_URL_LEN - self.estimated_length()
+
+    def would_fit(self, marker):
+        """Returns whether the URL stays within MAX_URL_LEN with marker added."""
+        style = (marker.size, marker.color, marker.label, marker.icon_url)
+        needed = _location_length(marker)
+        if style not in self._url_lengths().groups:
+            needed += 1 + len("markers=") + sum(
+                3 + _quoted_length(part) for part in _style_parts(style))
+        return needed <= self.remaining_budget()
+
+    def _url_lengths(self):
+        lengths = self._lengths
+        if lengths is None:
+            lengths = _UrlLengths()
+            for marker in self.markers:
+                lengths.add_marker(marker)
+            marker_set = self._marker_set
+            for style, group in zip(marker_set.styles, _split_by_style(marker_set)):
+                if group[0]:
+                    lengths.add_locations(style, *group)
+            if len(self.path) > 0 and not self.contains_addresses:
+                lengths.add_path(self.path.coordinates())
+            self._lengths = lengths
+        return lengths
+
+    def shard(self):
+        """
+        Returns as few maps as needed to draw this one within MAX_URL_LEN
+        each, to be overlaid: every shard has part of the markers and path
+        and the same center, zoom, size and styles. Markers are kept
+        together by style; a path is cut into consecutive pieces that
+        share their end points. Without a center or zoom, both are fitted
+        to the content (see auto_fit), which must then not include
+        addresses. Returns
+        [self] if the map fits in one URL.
+        """
+        if len(self._build_url()) <= Map.MAX_URL_LEN:
+            return [self]
+
+        base = copy.copy(self)
+        base.markers = []
+        base._marker_set = MarkerSet()
+        base.path = Path()
+        if not (self.center and self.zoom):
+            self._fit_viewport(base)
+        fixed = base.estimated_length()
+
+        def new_shard():
+            shard = copy.copy(base)
+            shard.markers = []
+            shard._marker_set = MarkerSet()
+            shard.path = Path()
+            shards.append(shard)
+            return shard
+
+        shards = []
+        length = fixed
+        if len(self.path) > 0:
+            pieces = self._path_pieces(base)
+            if self.region and len(pieces) > 1:
+                raise ValueError("A region path too long for one URL cannot be split")
+            for piece in pieces:
+                new_shard().path = piece
+            # the path is simplified as the URL is built; count what is left
+            length = len(shards[-1]._build_url())
+
+        # markers added with add_markers follow those added one by one, as in the URL
+        styles = []
+        items = {}
+        for marker in self.markers:
+            style = (marker.size, marker.color, marker.label, marker.icon_url)
+            if style not in items:
+                items[style] = []
+                styles.append(style)
+            items[style].append((_location_length(marker), marker))
+        marker_set = self._marker_set
+        for style, (lats, lons) in zip(marker_set.styles, _split_by_style(marker_set)):
+            if style not in items:
+                items[style] = []
+                styles.append(style)
+            items[style].extend((3 + _quoted_length(_point_text(*point)), point)
+                                for point in zip(lats, lons))
+
+        shard = shards[-1] if shards else new_shard()
+        shard_styles = set()
+        for style in styles:
+            overhead = 1 + len("markers=") + sum(
+                3 + _quoted_length(part) for part in _style_parts(style))
+            for location_cost, item in items[style]:
+                cost = location_cost
+                if style not in shard_styles:
+                    cost += overhead
+                if length + cost > Map.MAX_URL_LEN:
+                    shard = new_shard()
+                    shard_styles = set()
+                    length = fixed
+                    cost = location_cost + overhead
+                    if length + cost > Map.MAX_URL_LEN:
+                        raise ValueError("A marker does not fit in a URL of its own")
+                if isinstance(item, Marker):
+                    shard.markers.append(item)
+                else:
+                    shard._marker_set._add_styled(style, [item[0]], [item[1]])
+                shard_styles.add(style)
+                length += cost
+
+        for shard in shards:
+            # content was added behind the running counts' back
+            shard._lengths = None
+        return shards
+
+    def generate_urls(self):
+        """Returns the URLs of the shards of this map (see shard)."""
+        return [shard.generate_url() for shard in self.shard()]
+
+    def _fit_viewport(self, base):
+        box = self._bounds()
+        if box is None:
+            raise ValueError(
+                "Maps with addresses need a center and zoom to be sharded")
+        if not self.center:
+            base.center, base.zoom = self._fit(box)
+            return
+        # zoom out around the center that is sent, not the box's own
+        try:
+            lat, lon = [float(v) for v in self.center.split(',')]
+        except ValueError:
+            raise ValueError(
+                "Maps centered on an address need a zoom to be sharded")
+        base.zoom = mercator.fit_bounds_around(
+            lat, lon, *box, width=self.size_x, height=self.size_y,
+            max_zoom=self.FIT_MAX_ZOOM, padding=self.FIT_PADDING)
+
+    def _bounds(self):
+        """
+        Returns the box (see mercator.bounds) around the markers and path,
+        or None if there are none or any is an address.
+        """
+        if self.contains_addresses:
+            return None
+        lats = array('d')
+        lons = array('d')
+        for marker in self.markers:
+            if not isinstance(marker, LatLonMarker):
+                return None
+            lats.append(float(marker.latitude))
+            lons.append(float(marker.longitude))
+        boxes = []
+        if len(lats):
+            boxes.append(mercator.bounds(lats, lons))
+        if len(self._marker_set):
+            boxes.append(mercator.bounds(self._marker_set.lats, self._marker_set.lons))
+        if len(self.path):
+            coordinates = self.path.coordinates()
+            boxes.append(mercator.bounds(coordinates.ys, coordinates.xs))
+        return mercator.merge_bounds(boxes)
+
+    def _viewport(self):
+        """
+        Returns the center and zoom to send: the map's own or, with
+        auto_fit and no center, those fitted to the content.
+        """
+        if self.auto_fit and not self.center:
+            box = self._bounds()
+            if box is not None:
+                return self._fit(box)
+        return self.center, self.zoom
+
+    def _path_pieces(self, base):
+        """
+        Cuts the path into consecutive Paths, each as long as fits in a URL
+        of its own on top of base (an empty shard).
+        """
+        pieces = []
+        if self.contains_addresses:
+            budget = (Map.MAX_URL_LEN - base.estimated_length() -
+                      len("&path=") - len(self._path_style()))
+            items = list(self.path)
+            start = 0
+            while start < len(items):
+                end = start
+                length = -3
+                while end < len(items) and length + 3 + _quoted_length(items[end]) <= budget:
+                    length += 3 + _quoted_length(items[end])
+                    end += 1
+                if end - start < 2 and end < len(items):
+                    raise ValueError("A path step does not fit in a URL of its own")
+                piece = Path()
+                for item in items[start:end]:
+                    piece._add_quoted(item)
+                pieces.append(piece)
+                if end == len(items):
+                    break
+                start = end - 1
+            return pieces
+
+        # a piece is simplified on its own when its URL is built, so each
+        # candidate is measured by building that URL
+        coordinates = self.path.coordinates()
+        count = len(coordinates)
+        probe = copy.copy(base)
+        fixed = base.estimated_length()
+        budget = (Map.MAX_URL_LEN - fixed - len("&path=") -
+                  len(self._path_style()) - len("enc%3A"))
+
+        def measure(start, end):
+            piece = Path()
+            piece.add_latlons(coordinates.ys[start:end], coordinates.xs[start:end])
+            probe.path = piece
+            return piece, len(probe._build_url())
+
+        start = 0
+        while True:
+            # the longest piece whose unsimplified encoding fits is a first
+            # guess, as simplification only shortens it
+            guess = start
+            length = 0
+            units = (0, 0)
+            while guess < count:
+                encoded, plat, plng = _encode_points(coordinates, [guess], *units)
+                length += len(_escape(encoded))
+                if length > budget:
+                    break
+                units = (plat, plng)
+                guess += 1
+            end = max(guess, min(start + 2, count))
+
+            # then aim for the end at which the characters per point seen so
+            # far fill the URL, keeping the longest piece that fits and the
+            # shortest that does not as bounds
+            fits = None
+            too_long = None
+            bounded = 0
+            while True:
+                piece, length = measure(start, end)
+                if length <= Map.MAX_URL_LEN:
+                    fits, fits_length, fitting = end, length, piece
+                    if end == count:
+                        break
+                else:
+                    too_long, too_long_length = end, length
+                if fits is None:
+                    if too_long <= start + 2:
+                        raise ValueError("A path step does not fit in a URL of its own")
+                    end = start + 2
+                    continue
+                if too_long is None:
+                    per_point = max(fits_length - fixed, 1) / float(fits - start)
+                    end = count
+                elif too_long - fits > 1:
+                    bounded += 1
+                    if bounded % 2 == 0:
+                        # every other step bisects, so few steps are needed
+                        # however the lengths run
+                        end = (fits + too_long) // 2
+                        continue
+                    per_point = max(too_long_length - fits_length, 1) / float(too_long - fits)
+                    end = too_long - 1
+                else:
+                    break
+                aim = fits + int((Map.MAX_URL_LEN - fits_length) / per_point)
+                end = min(max(aim, fits + 1), end)
+            pieces.append(fitting)
+            if fits == count:
+                return pieces
+            start = fits - 1
 
     def add_marker(self, marker):
         if not isinstance(marker, Marker):
             raise ValueError("Must pass instance of Marker to add_marker")
         self.markers.append(marker)
+        if self._lengths is not None:
+            self._lengths.add_marker(marker)
+        self._changed()
+
+    def add_markers(self, lats, lons, size=None, color=None, label=None, icon_url=None):
+        """
+        Adds one marker per lat, lon pair, all of the same style. Much
+        cheaper than add_marker for thousands of markers: the style is
+        validated once and no Marker objects are created, as the markers
+        are kept by column in a MarkerSet.
+        """
+        marker_set = self._marker_set
+        start = len(marker_set)
+        marker_set.add_many(lats, lons, size, color, label, icon_url)
+        if self._lengths is not None and len(marker_set) > start:
+            self._lengths.add_locations(marker_set.styles[marker_set.style_ids[start]],
+                                        marker_set.lats[start:], marker_set.lons[start:])
+        self._changed()
+
+    def cluster_markers(self, pixels=20, method='grid'):
+        """
+        Merges the markers of each style that would be drawn within about
+        pixels of each other into one marker at their mean position (see
+        mercator.cluster for the methods), so that dense point sets fit in
+        one URL. Distances are measured at the map's zoom or, without one,
+        at the largest zoom that shows all markers at the map's size.
+        LatLonMarkers and markers added with add_markers are replaced by the
+        merged markers, kept as if added with add_markers; AddressMarkers
+        are kept as they are. Returns the number of markers removed.
+        """
+        styles = []
+        points = {}
+        kept = []
+
+        def add(style, lat, lon):
+            group = points.get(style)
+            if group is None:
+                group = points[style] = ([], [])
+                styles.append(style)
+            group[0].append(lat)
+            group[1].append(lon)
+
+        for marker in self.markers:
+            if isinstance(marker, LatLonMarker):
+                add((marker.size, marker.color, marker.label, marker.icon_url),
+                    float(marker.latitude), float(marker.longitude))
+            else:
+                kept.append(marker)
+        marker_set = self._marker_set
+        for lat, lon, style_id in zip(marker_set.lats, marker_set.lons,
+                                      marker_set.style_ids):
+            add(marker_set.styles[style_id], lat, lon)
+        if not styles:
+            return 0
+
+        zoom = self.zoom
+        if zoom is None:
+            zoom = mercator.fit_zoom(
+                [lat for style in styles for lat in points[style][0]],
+                [lon for style in styles for lon in points[style][1]],
+                self.size_x, self.size_y)
+        places = mercator.decimals(zoom)
+        clustered = MarkerSet()
+        for style in styles:
+            lats, lons, _ = mercator.cluster(points[style][0], points[style][1],
+                                             zoom, pixels, method)
+            clustered._add_styled(style, [round(lat, places) for lat in lats],
+                                  [round(lon, places) for lon in lons])
+
+        removed = len(self.markers) + len(marker_set) - len(kept) - len(clustered)
+        self.markers = kept
+        self._marker_set = clustered
+        return removed
 
     def add_path_address(self, address):
-        self.contains_addresses = True
-        self.path.append(quote(address))
+        self.path.add_address(address)
+        self._changed()
 
     def add_path_latlon(self, lat, lon):
-        self.path.append("%s,%s" % (quote(str(lat)), quote(str(lon))))
-
-    def generate_url(self):
+        self.path.add_latlon(lat, lon)
+        self._path_added(len(self.path) - 1)
+
+    def add_path_latlons(self, lats, lons):
+        """
+        Adds many path points at once. lats and lons may be any sequences
+        of numbers; float64 buffers (array('d'), numpy arrays, memoryviews)
+        are referenced rather than copied, so they must not be modified
+        before the URL is generated.
+        """
+        start = len(self.path)
+        self.path.add_latlons(lats, lons)
+        self._path_added(start)
+
+    def add_path_buffer(self, buf):
+        """
+        Adds path points from a buffer of interleaved float64 lat, lon
+        pairs, such as an mmap of a binary coordinate file. The buffer is
+        referenced rather than copied.
+        """
+        start = len(self.path)
+        self.path.add_buffer(buf)
+        self._path_added(start)
+
+    def _path_added(self, start):
+        if self._lengths is not None and not self.contains_addresses:
+            self._lengths.add_path(self.path.coordinates(start))
+        self._changed()
+
+    def _assemble(self, prefix, suffix):
         self.check_parameters()
-        query = "%smaptype=%s&format=%s&scale=%s&size=%sx%s&sensor=%s&language=%s" % (
-            self._get_key(),
-            self.maptype,
-            self.format,
-            self.scale,
-            self.size_x,
-            self.size_y,
-            self._get_sensor(),
-            self.language)
+        center, zoom = self._viewport()
+        path = None
+        if len(self.path) > 0:
+            if self.contains_addresses:
+                path = _escape("|".join(self.path))
+            elif self.auto_simplify:
+                budget = Map.MAX_URL_LEN - len(self._url_for(
+                    prefix, self._query_body(center, zoom, 'enc%3A'), suffix))
+                path = 'enc%3A' + self._fit_polyencode(budget)
+            else:
+                path = 'enc%3A' + _escape(self._polyencode())
+
+        return self._url_for(prefix, self._query_body(center, zoom, path), suffix)
+
+    def _query_prefix(self, query):
+        self._add_key(query)
+        query.add('maptype', self.maptype)
+        query.add('format', self.format)
+        query.add('scale', self.scale)
+        query.add('size', '%sx%s' % (self.size_x, self.size_y))
+        query.add('sensor', self._get_sensor())
+        query.add('language', self.language)
+
+    def _query_body(self, center, zoom, path):
+        """The quoted query of this map's own part; path is quoted too."""
+        query = _Query()
+
+        if center:
+            query.add('center', center)
+
+        if zoom:
+            query.add('zoom', zoom)
+
+        if len(self.markers) > 0 or len(self._marker_set) > 0:
+            self._add_markers(query)
 
-        if self.center:
-            query = "%s&center=%s" % (query, self.center)
+        if path is not None:
+            query.add_quoted('path', self._path_style() + path)
+
+        return query.text()
+
+    def _path_style(self):
+        """The quoted styles in front of the path's points."""
+        style = ''
 
-        if self.zoom:
-            query = "%s&zoom=%s" % (query, self.zoom)
+        if self.pathcolor:
+            style = "%scolor:%s|" % (style, self.pathcolor)
+
+        if self.pathweight:
+            style = "%sweight:%s|" % (style, self.pathweight)
+
+        if self.region:
+            style = "%sfillcolor:%s|" % (style, self.fillcolor)
 
-        if len(self.markers) > 0:
-            query = "%s&%s" % (query, self._generate_markers())
+        return _escape(style)
+
+    def _query_suffix(self, query):
+        pass
+
+
+def _style_parts(style):
+    parts = []
+    if style[0]:
+        parts.append("size:%s" % style[0])
+    if style[1]:
+        parts.append("color:%s" % style[1])
+    if style[2]:
+        parts.append("label:%s" % style[2])
+    if style[3]:
+        parts.append("icon:%s" % style[3])
+    return parts
+
+
+_SAFE = string.ascii_letters + string.digits + '_.-~/&=%'
+
+# the characters quote(text, safe='/&=%') escapes in ASCII text, with
+# their escapes
+_ESCAPES = dict((c, '%%%02X' % ord(c)) for c in map(chr, range(128))
+                if c not in _SAFE)
+_UNSAFE = frozenset(_ESCAPES)
+_UNSAFE_LIST = sorted(_ESCAPES)
+
+# below this length, finding the unsafe characters through a set beats
+# searching the text once for each of them
+_SHORT_TEXT = 64
+
+
+def _escape(text):
+    """
+    Quotes text as quote(text, safe='/&=%') does. Already quoted text is
+    left as it is. ASCII text, which is all but a few addresses, needs no
+    encoding: only the characters it contains are replaced, each in a
+    single pass.
+    """
+    if not text.rstrip(_SAFE):
+        return text
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return quote(text, safe='/&=%')
+    if len(text) < _SHORT_TEXT:
+        unsafe = _UNSAFE.intersection(text)
+    else:
+        unsafe = [c for c in _UNSAFE_LIST if c in text]
+    for c in unsafe:
+        text = text.replace(c, _ESCAPES[c])
+    return text
 
-        if len(self.path) > 0:
-            query = "%s&path=" % query
 
-            if self.pathcolor:
-                query = "%scolor:%s|" % (query, self.pathcolor)
+class _Query(object):
+    """
+    Collects query parameters, each value escaped once as it is added,
+    into a list that is joined once.
+    """
 
-            if self.pathweight:
-                query = "%sweight:%s|" % (query, self.pathweight)
+    def __init__(self):
+        self.parts = []
 
-            if self.region:
-                query = "%sfillcolor:%s|" % (query, self.fillcolor)
+    def add(self, name, value):
+        self.parts.append("&%s=%s" % (name, _escape(str(value))))
 
-            query = "%senc:%s" % (query, quote(self._polyencode()))
+    def add_quoted(self, name, value):
+        self.parts.append("&%s=%s" % (name, value))
 
-        if self.style:
-            for style_map in self.style:
-                query = "%s&style=feature:%s|element:%s|" % (
-                    query,
-                    (style_map['feature'] if 'feature' in style_map else 'all'),
-                    (style_map['element'] if 'element' in style_map else 'all'))
-                for prop, rule in style_map['rules'].items():
-                    query = "%s%s:%s|" % (query, prop, str(rule).replace('#', '0x'))
+    def append(self, quoted):
+        self.parts.append(quoted)
 
-        if self.channel:
-            query += '&channel=%s' % (self.channel)
+    def text(self):
+        return ''.join(self.parts)
 
-        url = self.base_url + self._sign(self.url_path + quote(query, safe='/&=%'))
 
-        self._check_url(url)
+def _quoted_length(text):
+    return len(_escape(text))
 
+
+def _location_length(marker):
+    """The quoted length of a marker's location, with its separator."""
+    if isinstance(marker, LatLonMarker):
+        # coordinates given as text may need quoting too, say " 11.5"
+        return 3 + _quoted_length("%s,%s" % (marker.latitude, marker.longitude))
+    return 3 + _quoted_length(quote(marker.address))
+
+
+def _split_by_style(marker_set):
+    """Returns the latitudes and longitudes of each style of marker_set."""
+    groups = [(array('d'), array('d')) for _ in marker_set.styles]
+    for lat, lon, style_id in zip(marker_set.lats, marker_set.lons,
+                                  marker_set.style_ids):
+        groups[style_id][0].append(lat)
+        groups[style_id][1].append(lon)
+    return groups
+
+
+class _UrlLengths(object):
+    """
+    Running quoted lengths of the parts of a DecoratedMap URL that grow
+    with its content: each marker group and the unsimplified encoded path.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.path = 0
+        self.units = (0, 0)
+
+    def add_marker(self, marker):
+        self._add_group((marker.size, marker.color, marker.label, marker.icon_url),
+                        _location_length(marker))
+
+    def add_locations(self, style, lats, lons):
+        # "|lat,lon" is quoted as "%7Clat%2Clon"
+        self._add_group(style, 3 * len(lats) + sum(
+            _quoted_length(_point_text(lat, lon)) for lat, lon in zip(lats, lons)))
+
+    def _add_group(self, style, length):
+        if style not in self.groups:
+            self.groups[style] = len("markers=") + sum(
+                3 + _quoted_length(part) for part in _style_parts(style))
+        self.groups[style] += length
+
+    def add_path(self, coordinates):
+        encoded, plat, plng = _encode_points(
+            coordinates, range(len(coordinates)), *self.units)
+        self.path += len(_escape(encoded))
+        self.units = (plat, plng)
+
+
+def _style_key(style):
+    return tuple('' if value is None else str(value) for value in style)
+
+
+class MapTemplate(object):
+    """
+    Generates URLs for many maps that differ only in their per-map fields.
+
+    The prototype map fixes everything else (key or client, maptype,
+    format, scale, size, language, styles...); that part of the query is
+    rendered and quoted once. generate_url() takes the fields of one map:
+
+        CenterMap:    address, or lat and lon
+        VisibleMap:   locations, a list of addresses and (lat, lon) tuples
+        DecoratedMap: lat and lon (center), zoom, markers and path, a list
+                      of (lat, lon) tuples
+    """
+
+    def __init__(self, prototype):
+        self.prototype = prototype
+        self._prefix = prototype._quoted_prefix()
+        self._suffix = prototype._quoted_suffix()
+
+    def generate_url(self, **fields):
+        record = copy.copy(self.prototype)
+        record._set_record(**fields)
+        url = record._assemble(self._prefix, self._suffix)
+        record._check_url(url)
         return url
@@ -0,0 +1,233 @@
+"""
+Bulk URL generation: one map URL per record, streamed from CSV or JSON
+lines, optionally across a pool of worker processes.
+
+Records are dicts of per-map fields (see MapTemplate):
+
+    center:     {"address": ...} or {"lat": ..., "lon": ...}
+    visible:    {"locations": ["an address", [lat, lon], ...]}
+    decorated:  {"lat": ..., "lon": ..., "zoom": ...,
+                 "markers": [{"lat": ..., "lon": ..., "color": ...,
+                              "size": ..., "label": ..., "icon_url": ...},
+                             {"address": ..., ...}],
+                 "path": [[lat, lon], ...]}
+
+All decorated fields are optional, so a record may be just a path. A CSV
+row describes a single location in columns: address, or lat and lon. For
+decorated maps that location becomes a marker styled by the size, color,
+label and icon_url columns. Any record may carry an id, which is written
+in front of its URL.
+
+    python -m motionless --map decorated --size 200x200 --key KEY \\
+        --workers 8 listings.csv > urls.tsv
+"""
+from __future__ import print_function
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from . import AddressMarker, CenterMap, DecoratedMap, LatLonMarker
+from . import MapTemplate, VisibleMap
+
+MAP_TYPES = {
+    'center': CenterMap,
+    'visible': VisibleMap,
+    'decorated': DecoratedMap,
+}
+
+MARKER_FIELDS = ('size', 'color', 'label', 'icon_url')
+
+
+def read_records(stream, fmt='jsonl'):
+    """Yields records from a stream of CSV rows or JSON lines."""
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield dict((k, v) for k, v in row.items() if v not in ('', None))
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(
+            "[%s] is not a valid record format. Valid formats are csv and jsonl" % fmt)
+
+
+def generate_urls(records, map_type='decorated', workers=None, chunk_size=500,
+                  skip_invalid=False, flat=False, **map_args):
+    """
+    Yields (id, url) for each record, in order. map_args are passed to the
+    map class and fix everything but the per-record fields. With workers,
+    records are built in that many processes, chunk_size records at a
+    time, with only a few chunks in flight so memory stays flat. Invalid
+    records raise ValueError, or yield (id, None) with skip_invalid. Pass
+    flat for CSV rows, which describe a single location each.
+    """
+    if map_type not in MAP_TYPES:
+        raise ValueError(
+            "[%s] is not a valid map type. Valid types include %s" %
+            (map_type, sorted(MAP_TYPES)))
+    if not workers:
+        # state of this generator only, so several can run side by side
+        template = MapTemplate(MAP_TYPES[map_type](**map_args))
+        for record in records:
+            yield _generate_url(template, map_type, skip_invalid, flat, record)
+        return
+
+    records = iter(records)
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(map_type, map_args, skip_invalid, flat)) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_generate_chunk, chunk))
+            if not pending:
+                break
+            for result in pending.popleft().result():
+                yield result
+
+
+# the template of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(map_type, map_args, skip_invalid, flat):
+    _worker['map_type'] = map_type
+    _worker['template'] = MapTemplate(MAP_TYPES[map_type](**map_args))
+    _worker['skip_invalid'] = skip_invalid
+    _worker['flat'] = flat
+
+
+def _generate_chunk(records):
+    template = _worker['template']
+    map_type = _worker['map_type']
+    skip_invalid = _worker['skip_invalid']
+    flat = _worker['flat']
+    return [_generate_url(template, map_type, skip_invalid, flat, record)
+            for record in records]
+
+
+def _generate_url(template, map_type, skip_invalid, flat, record):
+    record_id = record.get('id')
+    try:
+        url = template.generate_url(**_record_fields(map_type, flat, record))
+    except (ValueError, TypeError, KeyError) as e:
+        if not skip_invalid:
+            raise ValueError("Invalid record %r: %s" % (record, e))
+        url = None
+    return record_id, url
+
+
+def _record_fields(map_type, flat, record):
+    if map_type == 'center':
+        return dict((k, record[k]) for k in ('address', 'lat', 'lon') if k in record)
+
+    if map_type == 'visible':
+        if 'locations' in record:
+            locations = record['locations']
+        elif 'address' in record:
+            locations = [record['address']]
+        else:
+            locations = [(record['lat'], record['lon'])]
+        return {'locations': [tuple(location) if isinstance(location, list)
+                              else location for location in locations]}
+
+    fields = {}
+    if flat:
+        # a CSV row is a single marker
+        fields['markers'] = [_marker(record)]
+        if 'zoom' in record:
+            fields['zoom'] = record['zoom']
+        return fields
+    for k in ('lat', 'lon', 'zoom'):
+        if k in record:
+            fields[k] = record[k]
+    if 'markers' in record:
+        fields['markers'] = [_marker(marker) for marker in record['markers']]
+    if 'path' in record:
+        fields['path'] = [tuple(point) for point in record['path']]
+    return fields
+
+
+def _marker(fields):
+    style = dict((k, fields[k]) for k in MARKER_FIELDS if k in fields)
+    if 'address' in fields:
+        return AddressMarker(fields['address'], **style)
+    return LatLonMarker(fields['lat'], fields['lon'], **style)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m motionless',
+        description='Generate one Google Static Maps URL per input record.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='CSV or JSON lines file (default: stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='input format (default: from the file extension, else jsonl)')
+    parser.add_argument('--map', dest='map_type', choices=sorted(MAP_TYPES),
+                        default='decorated')
+    parser.add_argument('--size', default='400x400', help='WIDTHxHEIGHT')
+    parser.add_argument('--maptype', default='roadmap')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--zoom', type=int)
+    parser.add_argument('--language', default='en')
+    parser.add_argument('--style-file', help='JSON file with a list of styles')
+    parser.add_argument('--key')
+    parser.add_argument('--clientid')
+    parser.add_argument('--secret', default=os.environ.get('MOTIONLESS_SECRET'),
+                        help='client secret (default: $MOTIONLESS_SECRET)')
+    parser.add_argument('--channel')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes (default: none)')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help='write an empty line for invalid records instead of stopping')
+    args = parser.parse_args(argv)
+
+    if args.clientid and not args.secret:
+        parser.error('--clientid needs --secret or $MOTIONLESS_SECRET')
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'csv' if args.input.lower().endswith('.csv') else 'jsonl'
+    size_x, size_y = [int(v) for v in args.size.lower().split('x')]
+    map_args = dict(size_x=size_x, size_y=size_y, maptype=args.maptype,
+                    scale=args.scale, language=args.language, key=args.key,
+                    clientid=args.clientid, channel=args.channel)
+    if args.clientid:
+        map_args['secret'] = args.secret
+    if args.zoom is not None and args.map_type != 'visible':
+        map_args['zoom'] = args.zoom
+    if args.style_file:
+        with open(args.style_file) as f:
+            map_args['style'] = json.load(f)
+
+    source = sys.stdin if args.input == '-' else open(args.input, newline='')
+    target = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        results = generate_urls(read_records(source, fmt), args.map_type,
+                                workers=args.workers, chunk_size=args.chunk_size,
+                                skip_invalid=args.skip_invalid, flat=fmt == 'csv',
+                                **map_args)
+        for n, (record_id, url) in enumerate(results):
+            if url is None:
+                print('record %s is invalid' % (n + 1), file=sys.stderr)
+                url = ''
+            if record_id is None:
+                target.write(url + '\n')
+            else:
+                target.write('%s\t%s\n' % (record_id, url))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
@@ -0,0 +1,195 @@
+"""
+On-disk cache of static map images.
+
+Entries are keyed by the SHA-256 of the map URL without its signature, so
+re-signing a URL (or signing it with a rotated secret) still hits. Each
+entry is a file written to a temporary name and moved into place, so any
+number of processes can share one directory; a reader sees either a whole
+image or none. The modification time of an entry records when it was
+stored (for the TTL) and its access time when it was last read (for LRU
+eviction once the directory grows past max_bytes). Eviction goes down to
+90% of max_bytes, so the directory is only scanned again once another
+tenth has been stored.
+
+    cache = ImageCache('~/.cache/motionless', max_bytes=500 * 2 ** 20,
+                       ttl=30 * 86400)
+    async with Fetcher(cache=cache) as fetcher:
+        ...
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+_SIGNATURE = re.compile(r'&signature=[^&]*')
+
+_STALE_TEMP = 3600
+
+# mkstemp makes owner-only files; entries get the mode open() would give,
+# so workers running as other users can read them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# eviction leaves the directory at this fraction of max_bytes
+_LOW_WATER = 0.9
+
+
+class ImageCache(object):
+
+    def __init__(self, directory, max_bytes=None, ttl=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def key(url):
+        """Returns the cache key of url, which ignores its signature."""
+        return hashlib.sha256(_SIGNATURE.sub('', url).encode('utf-8')).hexdigest()
+
+    def path(self, url):
+        key = self.key(url)
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url):
+        """Returns the cached image for url, or None."""
+        path = self.path(url)
+        try:
+            with open(path, 'rb') as f:
+                stored = os.fstat(f.fileno()).st_mtime
+                now = time.time()
+                if self.ttl is not None and now - stored > self.ttl:
+                    data = None
+                else:
+                    data = f.read()
+        except (IOError, OSError):
+            return None
+        if data is None:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, (now, stored))
+        except OSError:
+            pass
+        return data
+
+    def copy_to(self, url, target):
+        """
+        Copies the cached image for url to the file target. Returns whether
+        there was one.
+        """
+        data = self.get(url)
+        if data is None:
+            return False
+        _write_atomic(target, lambda f: f.write(data))
+        return True
+
+    def put(self, url, data):
+        """Stores the image data for url."""
+        self._store(url, lambda f: f.write(data), len(data))
+
+    def put_file(self, url, source):
+        """Stores a copy of the image file source for url."""
+        def copy(f):
+            with open(source, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        self._store(url, copy, os.path.getsize(source))
+
+    def clear(self):
+        """Removes every entry."""
+        for path in self._entries():
+            if not os.path.basename(path).startswith('.'):
+                self._remove(path)
+        self._size = 0
+
+    def _store(self, url, write, size):
+        path = self.path(url)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        _write_atomic(path, write)
+        if self.max_bytes is not None:
+            # the Fetcher stores from several threads
+            with self._lock:
+                if self._size is None:
+                    self._evict()
+                else:
+                    self._size += size
+                    if self._size > self.max_bytes:
+                        self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used (and any expired) entries until the
+        directory fits in the low-water mark below max_bytes. Other
+        processes write to the same directory, so the size is recounted on
+        every eviction.
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for path, accessed, stored, size in self._stats():
+            if os.path.basename(path).startswith('.'):
+                # a temporary file; only remove those left behind by a crash
+                if now - stored > _STALE_TEMP:
+                    self._remove(path)
+                continue
+            if self.ttl is not None and now - stored > self.ttl:
+                self._remove(path)
+                continue
+            entries.append((accessed, size, path))
+            total += size
+        entries.sort()
+        low_water = self.max_bytes * _LOW_WATER
+        for accessed, size, path in entries:
+            if total <= low_water:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    def _entries(self):
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                yield os.path.join(directory, name)
+
+    def _stats(self):
+        for path in self._entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_atime, st.st_mtime, st.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_atomic(path, write):
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.chmod(temp, 0o666 & ~_UMASK)
+        os.replace(temp, path)
+    except BaseException:
+        ImageCache._remove(temp)
+        raise
@@ -0,0 +1,326 @@
+"""
+Asynchronous download of static map images.
+
+Fetcher keeps HTTP/1.1 keep-alive connections open per host and reuses
+them across requests, limits the number of requests in flight, retries
+429 and 5xx responses (and dropped connections) with exponential backoff,
+and can stream image bodies straight to disk. With an ImageCache (see
+motionless.cache) images already on disk are not fetched again. It needs
+nothing beyond the standard library:
+
+    async with Fetcher(concurrency=16) as fetcher:
+        images = await fetcher.fetch_all(maps)
+
+or, outside of a running event loop:
+
+    paths = download(maps, directory='thumbnails')
+"""
+import asyncio
+import hashlib
+import os
+import ssl
+import tempfile
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from . import Map, __version__
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+_READ_SIZE = 65536
+
+# mkstemp makes owner-only files; images get the mode open() would give
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class FetchError(IOError):
+
+    def __init__(self, message, status=None):
+        IOError.__init__(self, message)
+        self.status = status
+
+
+class _ConnectionLost(Exception):
+    pass
+
+
+class Fetcher(object):
+
+    def __init__(self, concurrency=8, retries=3, backoff=0.5, timeout=30.0,
+                 ssl_context=None, cache=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._semaphore = None
+        self._idle = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Closes every idle connection."""
+        idle = self._idle
+        self._idle = {}
+        for connections in idle.values():
+            for reader, writer in connections:
+                writer.close()
+
+    async def fetch(self, map_or_url, path=None):
+        """
+        Downloads the image of a Map (or a URL). Returns the body, or
+        streams it to path and returns path when one is given.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await self._fetch(_url_of(map_or_url), path)
+
+    async def fetch_all(self, maps, directory=None):
+        """
+        Downloads the images of an iterable of Maps (or URLs), at most
+        concurrency at a time. Returns the bodies in order or, with a
+        directory, the paths they were written to, named after a hash of
+        the URL.
+        """
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        items = enumerate(maps)
+        results = {}
+
+        async def worker():
+            for i, item in items:
+                path = None
+                if directory is not None:
+                    path = os.path.join(directory, _file_name(item))
+                results[i] = await self._fetch(_url_of(item), path)
+
+        workers = [asyncio.ensure_future(worker())
+                   for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        return [results[i] for i in range(len(results))]
+
+    async def _fetch(self, url, path):
+        cache = self.cache
+        if cache is None:
+            return await self._fetch_remote(url, path)
+        # cache I/O (and the occasional eviction scan) blocks, so it runs
+        # in the default executor rather than on the event loop
+        loop = asyncio.get_event_loop()
+        if path is None:
+            data = await loop.run_in_executor(None, cache.get, url)
+            if data is not None:
+                return data
+        elif await loop.run_in_executor(None, cache.copy_to, url, path):
+            return path
+        result = await self._fetch_remote(url, path)
+        if path is None:
+            await loop.run_in_executor(None, cache.put, url, result)
+        else:
+            await loop.run_in_executor(None, cache.put_file, url, path)
+        return result
+
+    async def _fetch_remote(self, url, path):
+        parts = urlsplit(url)
+        attempt = 0
+        while True:
+            try:
+                status, retry_after, result = await asyncio.wait_for(
+                    self._request(parts, path), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    _ConnectionLost) as e:
+                if attempt >= self.retries:
+                    raise FetchError("Fetching %s failed: %r" % (url, e))
+                delay = self.backoff * 2 ** attempt
+            else:
+                if status == 200:
+                    return result
+                if status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise FetchError(
+                        "Fetching %s failed with HTTP %s" % (url, status), status)
+                delay = self.backoff * 2 ** attempt
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _request(self, parts, path):
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        request = ('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: motionless/%s\r\n'
+                   'Accept-Encoding: identity\r\n\r\n' %
+                   (target, parts.netloc, __version__)).encode('ascii')
+
+        reader, writer, reused = await self._connect(key)
+        try:
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise _ConnectionLost("connection closed")
+            except (OSError, _ConnectionLost):
+                if not reused:
+                    raise
+                # the server dropped an idle keep-alive connection; that
+                # does not count as an attempt
+                writer.close()
+                reader, writer = await self._open(key)
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise _ConnectionLost("connection closed")
+
+            version, status = _parse_status(status_line)
+            headers = await _read_headers(reader)
+            keep_alive = (version == 'HTTP/1.1' and
+                          headers.get('connection', '').lower() != 'close')
+
+            if status == 200 and path is not None:
+                # a name of its own, as other tasks may fetch the same path
+                handle, partial = tempfile.mkstemp(
+                    dir=os.path.dirname(path) or '.',
+                    prefix='.%s.' % os.path.basename(path), suffix='.part')
+                try:
+                    with os.fdopen(handle, 'wb') as f:
+                        delimited = await _read_body(reader, headers, f.write)
+                    os.chmod(partial, 0o666 & ~_UMASK)
+                    os.replace(partial, path)
+                except BaseException:
+                    try:
+                        os.remove(partial)
+                    except OSError:
+                        pass
+                    raise
+                result = path
+            else:
+                chunks = []
+                delimited = await _read_body(reader, headers, chunks.append)
+                result = b''.join(chunks)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive and delimited:
+            self._idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+        return status, _retry_after(headers), result
+
+    async def _connect(self, key):
+        connections = self._idle.get(key)
+        while connections:
+            reader, writer = connections.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._open(key)
+        return reader, writer, False
+
+    async def _open(self, key):
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        return await asyncio.open_connection(host, port, ssl=context)
+
+
+def download(maps, directory=None, **fetcher_args):
+    """
+    Blocking wrapper around Fetcher.fetch_all for code without an event
+    loop. fetcher_args are passed to Fetcher.
+    """
+    async def run():
+        async with Fetcher(**fetcher_args) as fetcher:
+            return await fetcher.fetch_all(maps, directory)
+    return asyncio.run(run())
+
+
+def _url_of(map_or_url):
+    if isinstance(map_or_url, Map):
+        return map_or_url.generate_url()
+    return map_or_url
+
+
+def _file_name(map_or_url):
+    extension = getattr(map_or_url, 'format', 'png')
+    digest = hashlib.sha1(_url_of(map_or_url).encode('utf-8')).hexdigest()
+    return '%s.%s' % (digest, extension)
+
+
+def _parse_status(line):
+    parts = line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise _ConnectionLost("malformed status line %r" % line)
+    return parts[0], int(parts[1])
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise _ConnectionLost("connection closed in headers")
+        line = line.decode('latin-1').rstrip('\r\n')
+        if not line:
+            return headers
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _read_body(reader, headers, write):
+    """
+    Passes the body to write piece by piece. Returns whether the body was
+    delimited, i.e. whether the connection can carry another request.
+    """
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip any trailers
+                while (await reader.readline()).strip():
+                    pass
+                return True
+            while size:
+                data = await reader.readexactly(min(size, _READ_SIZE))
+                write(data)
+                size -= len(data)
+            await reader.readexactly(2)
+    if 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining:
+            data = await reader.readexactly(min(remaining, _READ_SIZE))
+            write(data)
+            remaining -= len(data)
+        return True
+    while True:
+        data = await reader.read(_READ_SIZE)
+        if not data:
+            return False
+        write(data)
+
+
+def _retry_after(headers):
+    try:
+        return float(headers['retry-after'])
+    except (KeyError, ValueError):
+        return None
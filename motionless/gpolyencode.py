@@ -40,17 +40,86 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
+import heapq
 import math
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 try:
-    from StringIO import StringIO
+    import numpy
 except ImportError:
-    from io import StringIO
+    numpy = None
+
+ENGINES = ('auto', 'python', 'numpy', 'hull')
+
+# Spans shorter than this are scanned in pure python even by the numpy
+# engine; below it the array setup costs more than the loop.
+_NUMPY_MIN_SPAN = 64
+
+# Relative slack used when the numpy engine shortlists candidate maxima.
+# numpy squares with x * x where python uses pow(x, 2); the two can differ
+# in the last bit, so candidates are re-scored with _distance to keep the
+# output identical to the python engine.
+_NUMPY_TOLERANCE = 1e-9
+
+# Points per leaf of the hull engine's segment tree; spans shorter than
+# _HULL_MIN_SPAN are scanned directly.
+_HULL_LEAF_SIZE = 16
+_HULL_MIN_SPAN = 64
+
+# Paths shorter than this are never simplified in parallel, and spans
+# shorter than _PARALLEL_MIN_SPAN are not split further to feed workers.
+_PARALLEL_MIN_POINTS = 100000
+_PARALLEL_MIN_SPAN = 10000
+
+# Paths handed to each executor task by encode_many.
+_ENCODE_MANY_BATCH = 256
+
+
+class Coordinates(object):
+    """
+    A sequence of (x, y) points backed by two separate coordinate
+    sequences, so arrays, memoryviews and numpy arrays can be encoded
+    without building a list of tuples first.
+    """
+
+    def __init__(self, xs, ys):
+        if len(xs) != len(ys):
+            raise ValueError(
+                "Coordinate sequences differ in length (%s and %s)" %
+                (len(xs), len(ys)))
+        self.xs = xs
+        self.ys = ys
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Coordinates(self.xs[index], self.ys[index])
+        return (self.xs[index], self.ys[index])
+
+    def __iter__(self):
+        return zip(self.xs, self.ys)
 
 
 class GPolyEncoder(object):
 
     def __init__(self, num_levels=18, zoom_factor=2, threshold=0.00001,
-                 force_endpoints=True):
+                 force_endpoints=True, engine='auto', workers=None,
+                 max_points=None, min_area=None):
+        if engine not in ENGINES:
+            raise ValueError(
+                "[%s] is not a valid engine. Valid engines include %s" %
+                (engine, ENGINES))
+        if engine == 'numpy' and numpy is None:
+            raise ValueError("The numpy engine requires numpy to be installed")
+        if engine == 'auto':
+            engine = 'python' if numpy is None else 'numpy'
+        self._engine = engine
+        self._workers = workers
+        # either of these selects Visvalingam-Whyatt over Douglas-Peucker
+        self._max_points = max_points
+        self._min_area = min_area
         self._num_levels = num_levels
         self._zoom_factor = zoom_factor
         self._threshold = threshold
@@ -61,32 +130,20 @@ class GPolyEncoder(object):
             self._zoom_level_breaks.append(
                 threshold * (zoom_factor ** (num_levels - i - 1)))
 
-    def encode(self, points):
-        dists = {}
-        # simplify using Douglas-Peucker
-        max_dist = 0
-        abs_max_dist = 0
-        stack = []
-        if (len(points) > 2):
-            stack.append((0, len(points) - 1))
-            while len(stack):
-                current = stack.pop()
-                max_dist = 0
-
-                for i in range(current[0] + 1, current[1]):
-                    temp = self._distance(points[i], points[current[0]],
-                                          points[current[1]])
-                    if temp > max_dist:
-                        max_dist = temp
-                        max_loc = i
-                        abs_max_dist = max(abs_max_dist, max_dist)
-
-                if max_dist > self._threshold:
-                    dists[max_loc] = max_dist
-                    stack.append((current[0], max_loc))
-                    stack.append((max_loc, current[1]))
+    def encode(self, points, levels=True):
+        """
+        Simplifies and encodes points, a sequence of (x, y) pairs. Pass
+        levels=False when only the encoded points are needed; 'levels' is
+        then None.
+        """
+        if self._max_points is not None or self._min_area is not None:
+            dists, abs_max_dist = self._simplify_visvalingam(points)
+        else:
+            # simplify using Douglas-Peucker
+            dists, abs_max_dist = self._simplify(points)
 
-        enc_points, enc_levels = self._encode(points, dists, abs_max_dist)
+        enc_points, enc_levels = self._encode(points, dists, abs_max_dist,
+                                              levels)
         r = {
             'points': enc_points,
             'levels': enc_levels,
@@ -95,44 +152,324 @@ class GPolyEncoder(object):
         }
         return r
 
-    def _encode(self, points, dists, abs_max_dist):
-        encoded_levels = StringIO()
-        encoded_points = StringIO()
+    def encode_many(self, paths, offsets=None, executor=None, levels=True):
+        """
+        Encodes many paths with this encoder and returns the results of
+        encode() in order.
 
-        plat = 0
-        plng = 0
+        paths is a list of point sequences or, when offsets is given, one
+        flat sequence of points holding path k at
+        paths[offsets[k]:offsets[k + 1]] (Coordinates slices are views).
+        Pass a concurrent.futures executor to spread the paths over its
+        workers in batches.
+        """
+        if offsets is not None:
+            paths = [paths[offsets[k]:offsets[k + 1]]
+                     for k in range(len(offsets) - 1)]
+        if executor is None:
+            return [self.encode(points, levels) for points in paths]
+        batches = [(self, paths[i:i + _ENCODE_MANY_BATCH], levels)
+                   for i in range(0, len(paths), _ENCODE_MANY_BATCH)]
+        results = []
+        for batch in executor.map(_encode_batch, batches):
+            results.extend(batch)
+        return results
 
-        if (self._force_endpoints):
-            encoded_levels.write(self._encode_number(self._num_levels - 1))
+    def iterencode(self, points, window=4096):
+        """
+        Encodes an iterable of points as a stream, yielding pieces of the
+        encoded points string as they are settled. At most window points
+        are held in memory, so the input can be a generator over a track
+        of any length. Each window is simplified on its own (see
+        IncrementalEncoder) and levels are not produced.
+        """
+        encoder = IncrementalEncoder(threshold=self._threshold, window=window,
+                                     engine=self._engine, retain=False)
+        for point in points:
+            encoded = encoder.append(point)
+            if encoded:
+                yield encoded
+        encoded = encoder.finish()
+        if encoded:
+            yield encoded
+
+    def significance(self, points):
+        """
+        Maps each interior point Douglas-Peucker would keep at a zero
+        threshold to the largest threshold at which it is still kept.
+        A single pass answers "which points survive threshold t" for every t.
+        """
+        significance = {}
+        self._simplify(points, threshold=0, significance=significance)
+        return significance
+
+    def encode_significant(self, points, significance, threshold,
+                           levels=True):
+        """
+        Encodes the points whose significance (see significance()) exceeds
+        threshold without simplifying again. Levels are derived from the
+        significance values.
+        """
+        dists = dict((i, d) for i, d in significance.items() if d > threshold)
+        abs_max_dist = max(dists.values()) if dists else 0
+        enc_points, enc_levels = self._encode(points, dists, abs_max_dist,
+                                              levels)
+        return {
+            'points': enc_points,
+            'levels': enc_levels,
+            'zoomFactor': self._zoom_factor,
+            'numLevels': self._num_levels,
+        }
+
+    def _simplify(self, points, threshold=None, significance=None):
+        if threshold is None:
+            threshold = self._threshold
+        dists = {}
+        abs_max_dist = 0
+        stack = []
+        if (len(points) > 2):
+            columns = self._columns(points) if self._engine == 'numpy' else None
+            farthest = self._farthest_finder(points, columns)
+            stack.append((0, len(points) - 1, float('inf')))
+            if self._workers and len(points) >= _PARALLEL_MIN_POINTS:
+                return self._simplify_parallel(
+                    points, columns, farthest, stack, threshold, significance)
+            while len(stack):
+                abs_max_dist = max(abs_max_dist, self._split(
+                    farthest, stack, threshold, dists, significance))
+        return dists, abs_max_dist
+
+    def visvalingam(self, points):
+        """
+        Simplifies points with Visvalingam-Whyatt: the point forming the
+        smallest triangle with its neighbours is dropped until at most
+        max_points remain and every remaining triangle is at least
+        min_area. Returns the kept interior points mapped to their
+        effective area.
+        """
+        n = len(points)
+        max_points = self._max_points
+        min_area = self._min_area
+        areas = {}
+        if n <= 2:
+            return areas
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        heap = []
+        for i in range(1, n - 1):
+            areas[i] = self._area(points[i - 1], points[i], points[i + 1])
+            heap.append((areas[i], i))
+        heapq.heapify(heap)
+        remaining = n
+        floor = 0
+        while heap:
+            area, i = heap[0]
+            if areas.get(i) != area:
+                # stale entry for a removed or re-measured point
+                heapq.heappop(heap)
+                continue
+            if ((max_points is None or remaining <= max_points) and
+                    (min_area is None or area >= min_area)):
+                break
+            heapq.heappop(heap)
+            del areas[i]
+            remaining -= 1
+            # effective areas never fall below that of an earlier removal
+            floor = max(floor, area)
+            p = prev[i]
+            q = nxt[i]
+            nxt[p] = q
+            prev[q] = p
+            for j in (p, q):
+                if 0 < j < n - 1:
+                    areas[j] = max(floor, self._area(
+                        points[prev[j]], points[j], points[nxt[j]]))
+                    heapq.heappush(heap, (areas[j], j))
+        return areas
+
+    def _simplify_visvalingam(self, points):
+        # levels expect distances, so effective areas are converted to the
+        # side of the equivalent square
+        dists = dict((i, math.sqrt(area))
+                     for i, area in self.visvalingam(points).items())
+        abs_max_dist = max(dists.values()) if dists else 0
+        return dists, abs_max_dist
+
+    def _area(self, p0, p1, p2):
+        return abs((p1[0] - p0[0]) * (p2[1] - p0[1]) -
+                   (p2[0] - p0[0]) * (p1[1] - p0[1])) / 2.0
+
+    def _split(self, farthest, stack, threshold, dists, significance):
+        first, last, bound = stack.pop()
+        max_dist, max_loc = farthest(first, last)
+        if max_dist > threshold:
+            dists[max_loc] = max_dist
+            # a point survives a threshold only if every split above it
+            # does too
+            bound = min(bound, max_dist)
+            if significance is not None:
+                significance[max_loc] = bound
+            stack.append((first, max_loc, bound))
+            stack.append((max_loc, last, bound))
+        return max_dist
+
+    def _simplify_parallel(self, points, columns, farthest, stack, threshold,
+                           significance):
+        # Douglas-Peucker spans are independent once split, so split the
+        # largest spans here until every worker has a few to chew on, then
+        # simplify those in a process pool. The result is identical to the
+        # sequential pass.
+        dists = {}
+        abs_max_dist = 0
+        while stack and len(stack) < 4 * self._workers:
+            largest = max(range(len(stack)),
+                          key=lambda i: stack[i][1] - stack[i][0])
+            if stack[largest][1] - stack[largest][0] < _PARALLEL_MIN_SPAN:
+                break
+            stack[largest], stack[-1] = stack[-1], stack[largest]
+            abs_max_dist = max(abs_max_dist, self._split(
+                farthest, stack, threshold, dists, significance))
+
+        # each job gets slices of the coordinate columns
+        xs, ys = columns or self._columns(points)
+        jobs = []
+        for first, last, bound in stack:
+            jobs.append((xs[first:last + 1], ys[first:last + 1], threshold,
+                         self._engine, significance is not None))
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            results = executor.map(_simplify_span, jobs)
+            for (first, last, bound), result in zip(stack, results):
+                span_dists, span_max_dist, span_significance = result
+                abs_max_dist = max(abs_max_dist, span_max_dist)
+                for i, dist in span_dists.items():
+                    dists[first + i] = dist
+                if significance is not None:
+                    for i, dist in span_significance.items():
+                        significance[first + i] = min(bound, dist)
+        return dists, abs_max_dist
+
+    def _columns(self, points):
+        """
+        Returns the x and y coordinates of points as two picklable
+        sequences: numpy arrays for the numpy engine, else arrays (or the
+        lists of a Coordinates).
+        """
+        if self._engine == 'numpy':
+            if isinstance(points, Coordinates):
+                return (numpy.asarray(points.xs, dtype=numpy.float64),
+                        numpy.asarray(points.ys, dtype=numpy.float64))
+            coords = numpy.asarray(points, dtype=numpy.float64)
+            return coords[:, 0], coords[:, 1]
+        if isinstance(points, Coordinates):
+            xs = points.xs
+            ys = points.ys
+            if isinstance(xs, memoryview):
+                xs = array('d', xs)
+            if isinstance(ys, memoryview):
+                ys = array('d', ys)
+            return xs, ys
+        return (array('d', [p[0] for p in points]),
+                array('d', [p[1] for p in points]))
+
+    def _farthest_finder(self, points, columns=None):
+        if self._engine == 'numpy':
+            xs, ys = columns or self._columns(points)
+
+            def farthest(first, last):
+                if last - first < _NUMPY_MIN_SPAN:
+                    return self._farthest(points, first, last)
+                return self._farthest_numpy(points, xs, ys, first, last)
+            return farthest
+
+        if self._engine == 'hull':
+            if isinstance(points, Coordinates):
+                tree = _HullTree(points.xs, points.ys)
+            else:
+                tree = _HullTree([p[0] for p in points], [p[1] for p in points])
+
+            def farthest(first, last):
+                if last - first < _HULL_MIN_SPAN:
+                    return self._farthest(points, first, last)
+                return tree.farthest(points, self._distance, first, last)
+            return farthest
+
+        return lambda first, last: self._farthest(points, first, last)
+
+    def _farthest(self, points, first, last):
+        max_dist = 0
+        max_loc = None
+        p1 = points[first]
+        p2 = points[last]
+        for i in range(first + 1, last):
+            temp = self._distance(points[i], p1, p2)
+            if temp > max_dist:
+                max_dist = temp
+                max_loc = i
+        return max_dist, max_loc
+
+    def _farthest_numpy(self, points, xs, ys, first, last):
+        x0 = xs[first + 1:last]
+        y0 = ys[first + 1:last]
+        x1 = xs[first]
+        y1 = ys[first]
+        x2 = xs[last]
+        y2 = ys[last]
+        if y1 == y2 and x1 == x2:
+            out = numpy.sqrt((y2 - y0) ** 2 + (x2 - x0) ** 2)
         else:
-            encoded_levels.write(self._encode_number(
-                self._num_levels - self._compute_level(abs_max_dist) - 1))
+            dy = y2 - y1
+            dx = x2 - x1
+            u = ((y0 - y1) * dy + (x0 - x1) * dx) / (dy ** 2 + dx ** 2)
+            out = numpy.sqrt((y0 - y1 - u * dy) ** 2 + (x0 - x1 - u * dx) ** 2)
+            before = u <= 0
+            out[before] = numpy.sqrt(
+                (y0[before] - y1) ** 2 + (x0[before] - x1) ** 2)
+            after = u >= 1
+            out[after] = numpy.sqrt(
+                (y0[after] - y2) ** 2 + (x0[after] - x2) ** 2)
+        approx = out.max()
+        if not approx > 0:
+            return 0, None
+        # re-score the shortlist exactly, in index order, so ties and
+        # last-bit differences resolve the same way as _farthest
+        max_dist = 0
+        max_loc = None
+        p1 = points[first]
+        p2 = points[last]
+        cutoff = approx * (1 - _NUMPY_TOLERANCE)
+        for i in numpy.flatnonzero(out >= cutoff):
+            i = int(i) + first + 1
+            temp = self._distance(points[i], p1, p2)
+            if temp > max_dist:
+                max_dist = temp
+                max_loc = i
+        return max_dist, max_loc
 
+    def _encode(self, points, dists, abs_max_dist, levels=True):
         n_points = len(points)
-        for i, p in enumerate(points):
-            if (i > 0) and (i < n_points - 1) and (i in dists):
-                encoded_levels.write(self._encode_number(
-                    self._num_levels - self._compute_level(dists[i]) - 1))
-
-            if (i in dists) or (i == 0) or (i == n_points - 1):
-                late5 = int(math.floor(p[1] * 1E5))
-                lnge5 = int(math.floor(p[0] * 1E5))
-                dlat = late5 - plat
-                dlng = lnge5 - plng
-                plat = late5
-                plng = lnge5
-                encoded_points.write(self._encode_signed_number(dlat))
-                encoded_points.write(self._encode_signed_number(dlng))
+        kept = sorted(dists)
+        if n_points:
+            kept.insert(0, 0)
+        if n_points > 1:
+            kept.append(n_points - 1)
+        encoded_points, _, _ = _encode_points(points, kept, 0, 0)
+        if not levels:
+            return encoded_points, None
 
         if (self._force_endpoints):
-            encoded_levels.write(self._encode_number(self._num_levels - 1))
+            end_level = _encode_unsigned(self._num_levels - 1)
         else:
-            encoded_levels.write(self._encode_number(
-                self._num_levels - self._compute_level(abs_max_dist) - 1))
+            end_level = _encode_unsigned(
+                self._num_levels - self._compute_level(abs_max_dist) - 1)
+        encoded_levels = [end_level]
+        for i in kept[1:-1]:
+            encoded_levels.append(_encode_unsigned(
+                self._num_levels - self._compute_level(dists[i]) - 1))
+        encoded_levels.append(end_level)
 
         return (
-            encoded_points.getvalue(),  # .replace("\\", "\\\\"),
-            encoded_levels.getvalue()
+            encoded_points,  # .replace("\\", "\\\\"),
+            ''.join(encoded_levels)
         )
 
     def _compute_level(self, abs_max_dist):
@@ -146,17 +483,10 @@ class GPolyEncoder(object):
         sgn_num = num << 1
         if num < 0:
             sgn_num = ~sgn_num
-        return self._encode_number(sgn_num)
+        return _encode_unsigned(sgn_num)
 
     def _encode_number(self, num):
-        s = StringIO()
-        while num >= 0x20:
-            next_val = (0x20 | (num & 0x1f)) + 63
-            s.write(chr(next_val))
-            num >>= 5
-        num += 63
-        s.write(chr(num))
-        return s.getvalue()
+        return _encode_unsigned(num)
 
     def _distance(self, p0, p1, p2):
         out = 0.0
@@ -176,3 +506,400 @@ class GPolyEncoder(object):
                 out = math.sqrt((p0[1] - p1[1] - u * (p2[1] - p1[1])) ** 2 \
                                 + (p0[0] - p1[0] - u * (p2[0] - p1[0])) ** 2)
         return out
+
+
+# Each number is written 5 bits at a time, low bits first, as chr(63 + bits)
+# with 0x20 set on every group but the last. Numbers below _SMALL_LIMIT
+# (every delta under about 5 metres at 1e-5 degrees per unit) come straight
+# from a table.
+_CONTINUED = [chr(63 + (0x20 | bits)) for bits in range(32)]
+_FINAL = [chr(63 + bits) for bits in range(32)]
+_SMALL_LIMIT = 1024
+_SMALL = [_FINAL[num] if num < 0x20 else _CONTINUED[num & 0x1f] + _FINAL[num >> 5]
+          for num in range(_SMALL_LIMIT)]
+
+
+def _encode_unsigned(num):
+    if num < _SMALL_LIMIT:
+        return _SMALL[num]
+    chars = []
+    while num >= 0x20:
+        chars.append(_CONTINUED[num & 0x1f])
+        num >>= 5
+    chars.append(_FINAL[num])
+    return ''.join(chars)
+
+
+def _encode_points(points, kept, plat, plng):
+    """
+    Delta-encodes points[i] for i in kept, starting from the previous point
+    (plat, plng) in 1e-5 degree units. Returns the encoded string and the
+    last point's units.
+    """
+    if numpy is not None and len(kept) >= _NUMPY_MIN_SPAN:
+        return _encode_points_numpy(points, kept, plat, plng)
+    out = []
+    append = out.append
+    small = _SMALL
+    floor = math.floor
+    for i in kept:
+        p = points[i]
+        late5 = int(floor(p[1] * 1E5))
+        lnge5 = int(floor(p[0] * 1E5))
+        delta = late5 - plat
+        num = ~(delta << 1) if delta < 0 else delta << 1
+        append(small[num] if num < _SMALL_LIMIT else _encode_unsigned(num))
+        delta = lnge5 - plng
+        num = ~(delta << 1) if delta < 0 else delta << 1
+        append(small[num] if num < _SMALL_LIMIT else _encode_unsigned(num))
+        plat = late5
+        plng = lnge5
+    return ''.join(out), plat, plng
+
+
+def _encode_points_numpy(points, kept, plat, plng):
+    if isinstance(points, Coordinates):
+        index = numpy.asarray(kept, dtype=numpy.intp)
+        lats = numpy.asarray(points.ys, dtype=numpy.float64)[index]
+        lngs = numpy.asarray(points.xs, dtype=numpy.float64)[index]
+    else:
+        coords = numpy.array([points[i] for i in kept], dtype=numpy.float64)
+        lats = coords[:, 1]
+        lngs = coords[:, 0]
+    units = numpy.empty((len(kept) + 1, 2), dtype=numpy.int64)
+    units[0] = (plat, plng)
+    units[1:, 0] = numpy.floor(lats * 1E5)
+    units[1:, 1] = numpy.floor(lngs * 1E5)
+    deltas = numpy.diff(units, axis=0).ravel()
+    nums = numpy.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # split every number into 5 bit groups, mark all but the last
+    # significant group as continued and keep the groups up to it
+    shifts = numpy.arange(0, 64, 5, dtype=numpy.int64)
+    groups = (nums[:, None] >> shifts) & 0x1f
+    lengths = numpy.maximum(
+        1, (numpy.arange(len(shifts)) * ((nums[:, None] >> shifts) > 0)).max(axis=1) + 1)
+    used = numpy.arange(len(shifts)) < lengths[:, None]
+    continued = numpy.arange(len(shifts)) < (lengths - 1)[:, None]
+    chars = (groups + 63 + 0x20 * continued)[used].astype(numpy.uint8)
+    last = units[-1]
+    return chars.tobytes().decode('ascii'), int(last[0]), int(last[1])
+
+
+class _HullTree(object):
+    """
+    Segment tree over path indices whose nodes hold the convex hull of
+    their points, as lower and upper chains in x order, and a circle
+    around them.
+
+    farthest() is a best-first search over the nodes, by an upper bound
+    on the distance of each node's points from the segment; leaves are
+    scanned with the same distance function as the python engine, so the
+    result is identical, ties included. For a node whose points all
+    project inside the segment, distance reduces to the perpendicular
+    distance, a linear function whose extremes on each chain are found by
+    binary search. Otherwise the bound is that of the circle.
+
+    Building takes O(n log n) time and memory (children's hulls are
+    merged, not re-sorted). On nearly-straight traces, which cost the
+    plain scan O(n) per split, a query opens O(log n) nodes at O(log n)
+    each. This is a speed-up for such traces, not a better worst case:
+    where points fold back past the ends of the segment (spirals,
+    out-and-back tracks) or lie within rounding of the segment (exactly
+    straight lines at a zero threshold), bounds prune little and a query
+    approaches a scan of the span, as with the python engine.
+    """
+
+    # absolute slack, in units of the largest coordinate, for the rounding
+    # of the python engine's distance; a few thousand ulps
+    TOLERANCE = 1e-12
+
+    def __init__(self, xs, ys):
+        self.xs = xs
+        self.ys = ys
+        scale = 0.0
+        for values in (xs, ys):
+            if len(values):
+                scale = max(scale, abs(max(values)), abs(min(values)))
+        self.slack = scale * self.TOLERANCE
+        self.root = self._build(0, len(xs))
+
+    def _build(self, lo, hi):
+        # node: [lo, hi, left, right, lower chain, upper chain, hull points,
+        #        circle x, circle y, circle radius]
+        if hi - lo <= _HULL_LEAF_SIZE:
+            order = sorted(range(lo, hi), key=self._key)
+            return self._node(lo, hi, None, None, order)
+        mid = (lo + hi) // 2
+        left = self._build(lo, mid)
+        right = self._build(mid, hi)
+        # two sorted runs: timsort merges them in linear time
+        order = sorted(left[6] + right[6], key=self._key)
+        return self._node(lo, hi, left, right, order)
+
+    def _key(self, i):
+        return (self.xs[i], self.ys[i], i)
+
+    def _node(self, lo, hi, left, right, order):
+        xs = self.xs
+        ys = self.ys
+        unique = []
+        for i in order:
+            if not unique or xs[i] != xs[unique[-1]] or ys[i] != ys[unique[-1]]:
+                unique.append(i)
+        lower = []
+        upper = []
+        for i in unique:
+            while len(lower) >= 2 and self._cross(lower[-2], lower[-1], i) < 0:
+                lower.pop()
+            lower.append(i)
+            while len(upper) >= 2 and self._cross(upper[-2], upper[-1], i) > 0:
+                upper.pop()
+            upper.append(i)
+        hull = sorted(set(lower) | set(upper), key=self._key)
+        # the hull's bounding box holds every point of the node
+        min_x = xs[order[0]]
+        max_x = xs[order[-1]]
+        hull_ys = [ys[i] for i in hull]
+        min_y = min(hull_ys)
+        max_y = max(hull_ys)
+        cx = (min_x + max_x) / 2.0
+        cy = (min_y + max_y) / 2.0
+        radius = math.sqrt((max_x - cx) ** 2 + (max_y - cy) ** 2)
+        return [lo, hi, left, right, lower, upper, hull, cx, cy, radius]
+
+    def _cross(self, o, a, b):
+        xs = self.xs
+        ys = self.ys
+        return ((xs[a] - xs[o]) * (ys[b] - ys[o]) -
+                (ys[a] - ys[o]) * (xs[b] - xs[o]))
+
+    def farthest(self, points, distance, first, last):
+        """
+        Returns the largest distance(points[i], points[first], points[last])
+        for i in (first, last) and the lowest i with it, or (0, None) if
+        every distance is 0, as GPolyEncoder._farthest does.
+        """
+        xs = self.xs
+        ys = self.ys
+        p1 = points[first]
+        p2 = points[last]
+        ax = xs[first]
+        ay = ys[first]
+        dx = xs[last] - ax
+        dy = ys[last] - ay
+        length = math.sqrt(dx * dx + dy * dy)
+        lo = first + 1
+        hi = last
+        slack = self.slack
+        max_dist = 0
+        max_loc = None
+        heap = [(0.0, 0, self.root)]
+        pushed = 1
+        while heap:
+            bound, _, node = heapq.heappop(heap)
+            if -bound + slack < max_dist:
+                # no remaining node can hold a point as far
+                break
+            if node[2] is None or not (lo <= node[0] and node[1] <= hi):
+                if node[2] is not None:
+                    for child in (node[2], node[3]):
+                        if child[1] > lo and child[0] < hi:
+                            heapq.heappush(
+                                heap, (-self._bound(child, lo, hi, ax, ay, dx, dy, length),
+                                       pushed, child))
+                            pushed += 1
+                    continue
+                for i in range(max(lo, node[0]), min(hi, node[1])):
+                    temp = distance(points[i], p1, p2)
+                    if temp > max_dist or (temp == max_dist and max_loc is not None
+                                           and i < max_loc):
+                        max_dist = temp
+                        max_loc = i
+                continue
+            for child in (node[2], node[3]):
+                heapq.heappush(
+                    heap, (-self._bound(child, lo, hi, ax, ay, dx, dy, length),
+                           pushed, child))
+                pushed += 1
+        return max_dist, max_loc
+
+    def _bound(self, node, lo, hi, ax, ay, dx, dy, length):
+        """
+        An upper bound, up to rounding, on the distance of the node's
+        points in [lo, hi) from the segment.
+        """
+        if not (lo <= node[0] and node[1] <= hi):
+            # only partly in the span; say nothing
+            return float('inf')
+        # the circle: distance of its center plus its radius
+        cx = node[7] - ax
+        cy = node[8] - ay
+        if length == 0:
+            return math.sqrt(cx * cx + cy * cy) + node[9]
+        t = (cx * dx + cy * dy) / (length * length)
+        t = min(max(t, 0.0), 1.0)
+        bound = math.sqrt((cx - t * dx) ** 2 + (cy - t * dy) ** 2) + node[9]
+        # the hull, when all of it projects inside the segment
+        t_min = -self._extreme(node, ax, ay, -dx, -dy) / length
+        t_max = self._extreme(node, ax, ay, dx, dy) / length
+        if t_min > self.slack and t_max < length - self.slack:
+            perpendicular = max(self._extreme(node, ax, ay, -dy, dx),
+                                self._extreme(node, ax, ay, dy, -dx)) / length
+            bound = min(bound, perpendicular)
+        return bound
+
+    def _extreme(self, node, ax, ay, fx, fy):
+        """
+        Returns the largest value of fx * (x - ax) + fy * (y - ay) over the
+        node's points.
+        """
+        return max(self._chain_extreme(node[4], ax, ay, fx, fy),
+                   self._chain_extreme(node[5], ax, ay, fx, fy))
+
+    def _chain_extreme(self, chain, ax, ay, fx, fy):
+        xs = self.xs
+        ys = self.ys
+
+        def value(k):
+            i = chain[k]
+            return fx * (xs[i] - ax) + fy * (ys[i] - ay)
+
+        n = len(chain)
+        # a linear function is unimodal along a convex chain: find where it
+        # stops rising, then settle rounding noise by climbing
+        k = 0
+        if n > 1 and value(1) > value(0):
+            lo = 1
+            hi = n - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if value(mid + 1) <= value(mid):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            k = lo
+        if value(n - 1) > value(k):
+            k = n - 1
+        while k + 1 < n and value(k + 1) > value(k):
+            k += 1
+        while k > 0 and value(k - 1) > value(k):
+            k -= 1
+        return value(k)
+
+
+def _encode_batch(job):
+    encoder, paths, levels = job
+    return [encoder.encode(points, levels) for points in paths]
+
+
+def _simplify_span(job):
+    xs, ys, threshold, engine, want_significance = job
+    encoder = GPolyEncoder(threshold=threshold, engine=engine)
+    significance = {} if want_significance else None
+    dists, abs_max_dist = encoder._simplify(
+        Coordinates(xs, ys), significance=significance)
+    return dists, abs_max_dist, significance
+
+
+class IncrementalEncoder(object):
+    """
+    Append-only polyline encoder for paths that grow over time, such as a
+    live vehicle track.
+
+    Points are committed to the encoded string once they fall behind a
+    tail window; only the tail (at most window points) is ever simplified
+    again, so the cost of an update does not grow with the track. Each
+    window is simplified with Douglas-Peucker on its own, so the result
+    stays within threshold but may keep a few more points than encoding
+    the whole path at once. Only points are produced, not levels.
+
+    With retain=False the committed characters are only returned by
+    append, extend and finish and not kept, so memory stays bounded
+    however long the path grows; committed is then always empty and
+    points only holds the tail.
+    """
+
+    def __init__(self, threshold=0.00001, window=256, engine='auto', retain=True):
+        if window < 3:
+            raise ValueError("window must hold at least 3 points")
+        self._encoder = GPolyEncoder(threshold=threshold, engine=engine)
+        self._window = window
+        self._retain = retain
+        self._committed = []
+        self._plat = 0
+        self._plng = 0
+        self._tail = []
+        self.count = 0
+
+    @property
+    def committed(self):
+        """The encoded points that will not change as points are added."""
+        if len(self._committed) > 1:
+            self._committed = [''.join(self._committed)]
+        return self._committed[0] if self._committed else ''
+
+    @property
+    def points(self):
+        """The encoded path, with the tail window simplified as it stands."""
+        tail = self._tail
+        if len(tail) < 2:
+            return self.committed
+        dists, _ = self._encoder._simplify(tail)
+        kept = sorted(dists)
+        kept.append(len(tail) - 1)
+        pending, _, _ = _encode_points(
+            tail, kept, self._plat, self._plng)
+        return self.committed + pending
+
+    def append(self, point):
+        """
+        Adds an (x, y) point and returns the characters this committed to
+        the encoded string, which are usually none.
+        """
+        self.count += 1
+        if not self._tail:
+            self._tail.append(point)
+            return self._commit([0])
+        self._tail.append(point)
+        if len(self._tail) <= self._window:
+            return ''
+        tail = self._tail
+        dists, _ = self._encoder._simplify(tail)
+        kept = sorted(dists)
+        # keep the last stretch of the window open so later points can
+        # still remove it; a stretch too long to keep is committed whole
+        if kept and len(tail) - kept[-1] <= self._window // 2:
+            cut = kept[-1]
+        else:
+            cut = len(tail) - 1
+            kept.append(cut)
+        committed = self._commit(kept)
+        self._tail = tail[cut:]
+        return committed
+
+    def extend(self, points):
+        """Adds each (x, y) point in turn; returns the committed characters."""
+        return ''.join([self.append(point) for point in points])
+
+    def finish(self):
+        """
+        Commits the tail window as it stands and returns its characters.
+        Points added afterwards start a new window from the last point.
+        """
+        tail = self._tail
+        if len(tail) < 2:
+            return ''
+        dists, _ = self._encoder._simplify(tail)
+        kept = sorted(dists)
+        kept.append(len(tail) - 1)
+        encoded = self._commit(kept)
+        self._tail = tail[-1:]
+        return encoded
+
+    def _commit(self, kept):
+        encoded, self._plat, self._plng = _encode_points(
+            self._tail, kept, self._plat, self._plng)
+        if self._retain:
+            self._committed.append(encoded)
+        return encoded
+
@@ -0,0 +1,227 @@
+"""
+Web Mercator helpers: conversions between latitude/longitude and the
+world pixel coordinates Google Static Maps draws in, the center and zoom
+of the smallest map showing a set of points, and clustering of points
+that would overlap on a map of a given zoom.
+
+At zoom z the world is 256 * 2 ** z pixels wide; x grows eastwards from
+the antimeridian and y southwards from the northern edge of the map.
+"""
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TILE_SIZE = 256
+
+# beyond this the projection is clipped, as on Google maps
+_MAX_SIN = 0.9999
+
+# numpy is only worth its setup cost for larger point sets
+_NUMPY_MIN_POINTS = 256
+
+
+def to_pixels(lat, lon, zoom):
+    """Returns the world pixel coordinates (x, y) of lat, lon at zoom."""
+    scale = TILE_SIZE * 2 ** zoom
+    siny = min(max(math.sin(math.radians(lat)), -_MAX_SIN), _MAX_SIN)
+    return ((lon + 180.0) / 360.0 * scale,
+            (0.5 - math.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * scale)
+
+
+def from_pixels(x, y, zoom):
+    """Returns the lat, lon of world pixel coordinates x, y at zoom."""
+    scale = TILE_SIZE * 2 ** zoom
+    lon = x / scale * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / scale))))
+    return lat, lon
+
+
+def decimals(zoom):
+    """
+    Returns the number of decimal places that resolves a pixel at zoom;
+    any more only lengthens URLs.
+    """
+    degrees_per_pixel = 360.0 / (TILE_SIZE * 2 ** zoom)
+    return max(0, int(math.ceil(-math.log10(degrees_per_pixel))) + 1)
+
+
+def fit_zoom(lats, lons, width, height, max_zoom=21, padding=0):
+    """
+    Returns the largest zoom at which all of lats, lons fit in a width x
+    height pixel map, at least padding pixels from its edges.
+    """
+    if not len(lats):
+        return max_zoom
+    return fit_bounds(*bounds(lats, lons), width=width, height=height,
+                      max_zoom=max_zoom, padding=padding)[2]
+
+
+def fit_viewport(lats, lons, width, height, max_zoom=21, padding=0):
+    """
+    Returns the center (lat, lon) and the largest zoom of a width x height
+    pixel map that shows all of lats, lons at least padding pixels from
+    its edges.
+    """
+    if not len(lats):
+        raise ValueError("Cannot fit a viewport to no points")
+    return fit_bounds(*bounds(lats, lons), width=width, height=height,
+                      max_zoom=max_zoom, padding=padding)
+
+
+def bounds(lats, lons):
+    """
+    Returns the south, west, north and east edges of the box around lats,
+    lons, in degrees. Boxes of several point sets combine with
+    merge_bounds.
+    """
+    if numpy is not None and len(lats) >= _NUMPY_MIN_POINTS:
+        # zero-copy for arrays, memoryviews and numpy arrays of floats
+        lats = numpy.asarray(lats, dtype=float)
+        lons = numpy.asarray(lons, dtype=float)
+        return (float(lats.min()), float(lons.min()),
+                float(lats.max()), float(lons.max()))
+    return (float(min(lats)), float(min(lons)),
+            float(max(lats)), float(max(lons)))
+
+
+def merge_bounds(boxes):
+    """Returns the box around all of boxes, or None if there are none."""
+    boxes = list(boxes)
+    if not boxes:
+        return None
+    south, west, north, east = zip(*boxes)
+    return min(south), min(west), max(north), max(east)
+
+
+def fit_bounds(south, west, north, east, width, height, max_zoom=21, padding=0):
+    """
+    Returns the center (lat, lon) and the largest zoom of a width x height
+    pixel map that shows the box south, west, north, east at least
+    padding pixels from its edges. The center is that of the box as
+    projected, not the mean of its edges' latitudes.
+    """
+    # x grows with longitude and y falls with latitude
+    left, top = to_pixels(north, west, 0)
+    right, bottom = to_pixels(south, east, 0)
+    lat, lon = from_pixels((left + right) / 2, (top + bottom) / 2, 0)
+    zoom = _zoom_for(right - left, bottom - top, max(width - 2 * padding, 1),
+                     max(height - 2 * padding, 1), max_zoom)
+    return lat, lon, zoom
+
+
+def fit_bounds_around(lat, lon, south, west, north, east, width, height,
+                      max_zoom=21, padding=0):
+    """
+    Returns the largest zoom of a width x height pixel map centered on
+    lat, lon that shows the box south, west, north, east at least padding
+    pixels from its edges.
+    """
+    x, y = to_pixels(lat, lon, 0)
+    left, top = to_pixels(north, west, 0)
+    right, bottom = to_pixels(south, east, 0)
+    return _zoom_for(2 * max(x - left, right - x), 2 * max(y - top, bottom - y),
+                     max(width - 2 * padding, 1), max(height - 2 * padding, 1),
+                     max_zoom)
+
+
+def _zoom_for(span_x, span_y, width, height, max_zoom):
+    zoom = max_zoom
+    while zoom > 0 and (span_x * 2 ** zoom > width or span_y * 2 ** zoom > height):
+        zoom -= 1
+    return zoom
+
+
+def cluster(lats, lons, zoom, pixels=20, method='grid'):
+    """
+    Merges points closer than about pixels apart at zoom. Returns the
+    latitudes, longitudes and member counts of the clusters, each placed at
+    the mean of its members, in order of each cluster's first member.
+
+    method 'grid' merges the points falling in the same pixels x pixels
+    cell. 'distance' makes each point that is more than pixels away from
+    every earlier cluster's first member the first member of a new
+    cluster, and adds every other point to the nearest such cluster; it
+    never merges points further apart than 2 * pixels, nor leaves two
+    cluster seeds within pixels. Both look up neighbours through a hash of
+    grid cells, so they take linear time.
+    """
+    if method == 'grid':
+        if numpy is not None and len(lats) >= _NUMPY_MIN_POINTS:
+            return _grid_cluster_numpy(lats, lons, zoom, pixels)
+        return _grid_cluster(lats, lons, zoom, pixels)
+    if method == 'distance':
+        return _distance_cluster(lats, lons, zoom, pixels)
+    raise ValueError(
+        "[%s] is not a valid clustering method. Valid methods are grid and distance" % method)
+
+
+def _grid_cluster(lats, lons, zoom, pixels):
+    cells = {}
+    clusters = []
+    for lat, lon in zip(lats, lons):
+        x, y = to_pixels(lat, lon, zoom)
+        key = (int(x // pixels), int(y // pixels))
+        members = cells.get(key)
+        if members is None:
+            members = cells[key] = [0, 0.0, 0.0]
+            clusters.append(members)
+        members[0] += 1
+        members[1] += lat
+        members[2] += lon
+    return _means(clusters)
+
+
+def _grid_cluster_numpy(lats, lons, zoom, pixels):
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    scale = TILE_SIZE * 2 ** zoom
+    siny = numpy.clip(numpy.sin(numpy.radians(lats)), -_MAX_SIN, _MAX_SIN)
+    xs = (lons + 180.0) / 360.0 * scale
+    ys = (0.5 - numpy.log((1 + siny) / (1 - siny)) / (4 * math.pi)) * scale
+    cells = numpy.stack([numpy.floor_divide(xs, pixels),
+                         numpy.floor_divide(ys, pixels)], axis=1)
+    _, first, inverse = numpy.unique(cells, axis=0, return_index=True,
+                                     return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = numpy.bincount(inverse)
+    mean_lats = numpy.bincount(inverse, weights=lats) / counts
+    mean_lons = numpy.bincount(inverse, weights=lons) / counts
+    order = numpy.argsort(first, kind='stable')
+    return (mean_lats[order].tolist(), mean_lons[order].tolist(),
+            counts[order].tolist())
+
+
+def _distance_cluster(lats, lons, zoom, pixels):
+    limit = pixels * pixels
+    seeds = {}
+    clusters = []
+    for lat, lon in zip(lats, lons):
+        x, y = to_pixels(lat, lon, zoom)
+        cx = int(x // pixels)
+        cy = int(y // pixels)
+        nearest = None
+        best = limit
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for seed in seeds.get((i, j), ()):
+                    d = (seed[0] - x) ** 2 + (seed[1] - y) ** 2
+                    if d <= best:
+                        nearest = seed
+                        best = d
+        if nearest is None:
+            nearest = (x, y, [0, 0.0, 0.0])
+            seeds.setdefault((cx, cy), []).append(nearest)
+            clusters.append(nearest[2])
+        members = nearest[2]
+        members[0] += 1
+        members[1] += lat
+        members[2] += lon
+    return _means(clusters)
+
+
+def _means(clusters):
+    return ([total_lat / count for count, total_lat, _ in clusters],
+            [total_lon / count for count, _, total_lon in clusters],
+            [count for count, _, _ in clusters])
@@ -4,9 +4,50 @@ Unit tests
 from __future__ import print_function
 import base64
 import unittest
+from array import array
 
 from motionless import CenterMap, DecoratedMap, LatLonMarker
-from motionless import VisibleMap, AddressMarker
+from motionless import VisibleMap, AddressMarker, UrlSigner, MapTemplate
+from motionless import StyleSheet
+from motionless.gpolyencode import GPolyEncoder, IncrementalEncoder
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _wiggly_track(n, seed=7):
+    import random
+    rnd = random.Random(seed)
+    lng, lat = 11.5, 48.1
+    points = []
+    for _ in range(n):
+        lng += rnd.uniform(-1e-4, 1e-4) * rnd.choice([1, 10])
+        lat += rnd.uniform(-1e-4, 1e-4)
+        points.append((lng, lat))
+    return points
+
+
+def _decode(encoded):
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lng / 1E5, lat / 1E5))
+    return points
 
 
 class TestMotionless(unittest.TestCase):
@@ -53,15 +94,35 @@ class TestMotionless(unittest.TestCase):
             '%2C%20ca&zoom=17&size=400x400&sensor=false&language=en')
 
     def test_addressmarker(self):
-
-        # For some reason the url is not always same. So the test is... well.
         dmap = DecoratedMap()
         am = AddressMarker('1 Infinite Loop, Cupertino, CA', label='A')
         dmap.add_marker(am)
         am = AddressMarker('1600 Amphitheatre Parkway Mountain View, CA',
                            label='G')
         dmap.add_marker(am)
-        _ = dmap.generate_url()
+        self.assertEqual(
+            dmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&language=en&'
+            'markers=%7Clabel%3AA%7C1%20Infinite%20Loop%2C%20Cupertino%2C%20CA&'
+            'markers=%7Clabel%3AG%7C1600%20Amphitheatre%20Parkway%20Mountain%20View%2C%20CA')
+
+    def test_canonical(self):
+        styles = [{'feature': 'road', 'rules': {'visibility': 'off', 'color': '#ff0000'}}]
+        markers = [LatLonMarker(1, 2, color='red'), LatLonMarker(3, 4, label='B'),
+                   LatLonMarker(5, 6, color='red'), AddressMarker('Paris', label='B')]
+        urls = set()
+        for order in ([0, 1, 2, 3], [3, 2, 1, 0], [1, 3, 0, 2]):
+            dmap = DecoratedMap(style=styles, canonical=True)
+            for i in order:
+                dmap.add_marker(markers[i])
+            urls.add(dmap.generate_url())
+            styles = [{'feature': 'road', 'rules': {'color': '#ff0000', 'visibility': 'off'}}]
+        self.assertEqual(len(urls), 1)
+        self.assertTrue(urls.pop().endswith(
+            'markers=%7Clabel%3AB%7C3%2C4%7CParis&'
+            'markers=%7Ccolor%3Ared%7C1%2C2%7C5%2C6&'
+            'style=feature%3Aroad%7Celement%3Aall%7Ccolor%3A0xff0000%7Cvisibility%3Aoff%7C'))
 
     def test_create_marker_map_with_styles(self):
         """Check correct url generated with markers + styles"""
@@ -84,6 +145,36 @@ class TestMotionless(unittest.TestCase):
             'color%3A0xc280e9%7C'
         )
 
+    def test_style_sheet(self):
+        styles = [{'feature': 'road', 'rules': {'visibility': 'off', 'color': '#ff0000'}},
+                  {'element': 'labels', 'rules': {'visibility': 'off'}}]
+        sheet = StyleSheet(styles)
+        fragment = ('&style=feature%3Aroad%7Celement%3Aall%7Cvisibility%3Aoff%7C'
+                    'color%3A0xff0000%7C&style=feature%3Aall%7Celement%3Alabels%7C'
+                    'visibility%3Aoff%7C')
+        self.assertEqual(sheet.fragment(), fragment)
+        self.assertTrue(sheet.fragment() is sheet.fragment())
+
+        cmap = CenterMap(lat=48.858278, lon=2.294489, style=sheet)
+        self.assertEqual(
+            cmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&center=48.858278%2C2.294489&zoom=17&size=400x400&'
+            'sensor=false&language=en' + fragment)
+        vmap = VisibleMap(style=styles)
+        vmap.add_address('Paris')
+        self.assertTrue(vmap.generate_url().endswith('&language=en' + fragment))
+        vmap.style = styles[1:]
+        self.assertTrue(vmap.generate_url().endswith(
+            '&language=en&style=feature%3Aall%7Celement%3Alabels%7Cvisibility%3Aoff%7C'))
+
+        dmap = DecoratedMap(style=sheet)
+        dmap.add_marker(LatLonMarker(1, 2))
+        listed = DecoratedMap(style=styles)
+        listed.add_marker(LatLonMarker(1, 2))
+        self.assertEqual(dmap.generate_url(), listed.generate_url())
+        self.assertTrue(dmap.generate_url().endswith(fragment))
+
     def test_demos(self):
 
         # Quick n dirty test to see if demos are OK
@@ -96,14 +187,24 @@ class TestMotionless(unittest.TestCase):
             # This can happen, it doesn't really matter
             return
 
-        sys.path.append(ex_dir)
-        import demo
-        import munich
+        # the demos write their pages to the working directory
+        import shutil
+        import tempfile
+        cwd = os.getcwd()
+        out_dir = tempfile.mkdtemp()
+        os.chdir(out_dir)
         try:
-            import geojson
-            import earthquakes
-        except ImportError:
-            pass
+            sys.path.append(ex_dir)
+            import demo
+            import munich
+            try:
+                import geojson
+                import earthquakes
+            except ImportError:
+                pass
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(out_dir)
 
     def test_api_key(self):
         cmap = CenterMap(
@@ -228,5 +329,862 @@ class TestMotionless(unittest.TestCase):
             'color%3A0xc280e9%7C&channel=somechannel&signature=IPHCEq1ifL7Chuwu604pMtN6eGw='
         )
 
+    def test_auto_simplify_fits_url(self):
+        track = _wiggly_track(20000)
+        dmap = DecoratedMap(simplify_threshold_meters=None)
+        for lng, lat in track:
+            dmap.add_path_latlon(lat, lon=lng)
+        self.assertRaises(ValueError, dmap.generate_url)
+
+        dmap.auto_simplify = True
+        url = dmap.generate_url()
+        self.assertTrue(len(url) <= DecoratedMap.MAX_URL_LEN)
+        self.assertTrue(len(url) > DecoratedMap.MAX_URL_LEN - 100)
+
+    def test_add_markers(self):
+        lats = [37.25, 37.5, 38.125]
+        lons = [-122.5, -122.25, -121.75]
+        expected = DecoratedMap()
+        expected.add_marker(LatLonMarker(1.5, 2.5, color='blue'))
+        for lat, lon in zip(lats, lons):
+            expected.add_marker(LatLonMarker(lat, lon, color='red', size='tiny'))
+        expected.add_marker(LatLonMarker(lats[0], lons[0], color='blue'))
+        expected.add_marker(LatLonMarker(lats[1], lons[1], label='C'))
+
+        dmap = DecoratedMap()
+        dmap.add_marker(LatLonMarker(1.5, 2.5, color='blue'))
+        dmap.add_markers(array('d', lats), lons, color='red', size='tiny')
+        dmap.add_markers(lats[:1], lons[:1], color='blue')
+        dmap.add_markers(lats[1:2], lons[1:2], label='C')
+        self.assertEqual(dmap.generate_url(), expected.generate_url())
+        self.assertEqual(len(dmap._marker_set.styles), 3)
+        dmap.add_markers([1], [2], label='C')
+        expected.add_marker(LatLonMarker(1, 2, label='C'))
+        self.assertEqual(dmap.generate_url(), expected.generate_url())
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+
+        self.assertRaises(ValueError, dmap.add_markers, lats, lons, color='mauve')
+        self.assertRaises(ValueError, dmap.add_markers, lats, lons[:2])
+
+        if numpy is not None:
+            dmap = DecoratedMap()
+            dmap.add_markers(numpy.array(lats), numpy.array(lons))
+            self.assertEqual(
+                dmap.generate_url(),
+                'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+                'format=png&scale=1&size=400x400&sensor=false&language=en&'
+                'markers=%7C37.25%2C-122.5%7C37.5%2C-122.25%7C38.125%2C-121.75')
+
+    def test_cluster_markers(self):
+        from motionless import mercator
+        lat, lon = mercator.from_pixels(*mercator.to_pixels(48.137, 11.575, 12), zoom=12)
+        self.assertAlmostEqual(lat, 48.137)
+        self.assertAlmostEqual(lon, 11.575)
+
+        import random
+        rnd = random.Random(3)
+        lats = [rnd.gauss(48.1, 0.05) for _ in range(2000)]
+        lons = [rnd.gauss(11.5, 0.1) for _ in range(2000)]
+        python = mercator._grid_cluster(lats, lons, 10, 20)
+        self.assertEqual(sum(python[2]), 2000)
+        if numpy is not None:
+            clustered = mercator._grid_cluster_numpy(lats, lons, 10, 20)
+            self.assertEqual(clustered[2], python[2])
+            for a, b in zip(clustered[0] + clustered[1], python[0] + python[1]):
+                self.assertAlmostEqual(a, b)
+
+        counts = mercator.cluster(lats, lons, 10, 20, 'distance')[2]
+        self.assertEqual(sum(counts), 2000)
+        self.assertTrue(len(counts) < 500)
+        self.assertRaises(ValueError, mercator.cluster, lats, lons, 10, 20, 'kmeans')
+
+        dmap = DecoratedMap(size_x=640, size_y=440)
+        dmap.add_marker(AddressMarker('Munich', label='M'))
+        dmap.add_marker(LatLonMarker('48.1', '11.5', color='blue'))
+        dmap.add_markers(lats, lons, size='tiny', color='red')
+        removed = dmap.cluster_markers()
+        self.assertEqual(len(dmap.markers), 1)
+        self.assertEqual(len(dmap._marker_set) + removed, 2001)
+        self.assertEqual(dmap._marker_set.styles,
+                         [(None, 'blue', None, None), ('tiny', 'red', None, None)])
+        self.assertTrue(len(dmap.generate_url()) <= DecoratedMap.MAX_URL_LEN)
+
+    def test_compact(self):
+        cmap = CenterMap(lat=48.858278123456, lon=2.294489987654)
+        self.assertEqual(cmap.compact(5), 14)
+        self.assertEqual(cmap.center, '48.85828,2.29449')
+
+        vmap = VisibleMap()
+        vmap.add_latlon(37.4227821234, -122.0850991234)
+        vmap.add_address('Tahoe City, CA')
+        vmap.add_latlon('37.42278', '-122.08510')
+        saved = vmap.compact(4)
+        self.assertEqual(vmap.locations, ['37.4228,-122.0851', 'Tahoe%20City%2C%20CA'])
+        self.assertEqual(saved, len('%7C37.42278%2C-122.08510') + 12)
+
+        shared = LatLonMarker(48.1000001, 11.5, color='0xff0000FF')
+        dmap = DecoratedMap(pathcolor='0x0000ffff')
+        dmap.add_marker(shared)
+        dmap.add_marker(LatLonMarker(48.1, 11.5000004, color='0xff0000'))
+        dmap.add_marker(AddressMarker('Munich'))
+        dmap.add_marker(AddressMarker('Munich'))
+        dmap.add_markers([1.23456789, 1.2345678], [2, 2], size='tiny')
+        dmap.add_path_latlon(48.1, 11.5)
+        dmap.add_path_latlon(48.2, 11.6)
+        before = len(dmap.generate_url())
+        saved = dmap.compact()
+        self.assertEqual(len(dmap.generate_url()), before - saved)
+        self.assertEqual(
+            dmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&language=en&'
+            'markers=%7Ccolor%3A0xff0000%7C48.1%2C11.5&markers=%7CMunich&'
+            'markers=%7Csize%3Atiny%7C1.234568%2C2&'
+            'path=color%3A0x0000ff%7Cenc%3A_pqdH_beeA_pR_pR')
+        self.assertEqual(shared.latitude, 48.1000001)
+        self.assertEqual(shared.color, '0xff0000FF')
+
+        # styles stay unique through a compacted set
+        compacted = dmap._marker_set.compacted(3)
+        compacted.add(5, 6, size='tiny')
+        compacted.add_many([7], [8], size='tiny')
+        self.assertEqual(compacted.styles, [('tiny', None, None, None)])
+        self.assertEqual(list(compacted.style_ids), [0, 0, 0])
+
+    def test_estimated_length(self):
+        import random
+        rnd = random.Random(5)
+        dmap = DecoratedMap(clientid='gme-exampleClientId',
+                            secret='vNIXE0xscrmjlyV-12Nj_BvUPaw=',
+                            style=[{'feature': 'road', 'rules': {'color': '#ff0000'}}])
+        dmap.add_marker(AddressMarker('1 Infinite Loop, Cupertino, CA', label='A'))
+        dmap.add_markers([1.5, 2.25], [3.5, -4.125], size='tiny')
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+        for _ in range(50):
+            dmap.add_path_latlon(48 + rnd.random(), 11 + rnd.random())
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+
+        # fill a map up to the limit, one marker at a time
+        added = 0
+        while True:
+            marker = LatLonMarker(round(rnd.uniform(-80, 80), 5),
+                                  round(rnd.uniform(-170, 170), 5),
+                                  color=rnd.choice(['red', 'blue', None]))
+            if not dmap.would_fit(marker):
+                break
+            dmap.add_marker(marker)
+            added += 1
+        self.assertTrue(added > 100)
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+        self.assertTrue(0 <= dmap.remaining_budget() < 40)
+        dmap.add_marker(marker)
+        self.assertRaises(ValueError, dmap.generate_url)
+
+    def test_estimated_length_quoted_coordinates(self):
+        # coordinates given as text are quoted as they are
+        dmap = DecoratedMap(key='abc')
+        dmap.add_marker(LatLonMarker(' 48.1', '11.5 ', color='red'))
+        dmap.add_marker(LatLonMarker('48.2', '11.6', color='red'))
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+        before = dmap.estimated_length()
+        marker = LatLonMarker('  48.3', '  11.7', color='red')
+        dmap.add_marker(marker)
+        self.assertEqual(dmap.estimated_length(), len(dmap.generate_url()))
+        self.assertEqual(dmap.estimated_length() - before, len('%7C%20%2048.3%2C%20%2011.7'))
+
+    def test_shard(self):
+        import math
+        import random
+        from motionless import mercator
+        rnd = random.Random(4)
+        dmap = DecoratedMap(size_x=640, size_y=640, pathcolor='blue', key='abc')
+        dmap.add_marker(LatLonMarker(48.1, 11.5, label='M'))
+        self.assertEqual(dmap.shard(), [dmap])
+
+        for _ in range(300):
+            dmap.add_marker(LatLonMarker(round(rnd.uniform(47, 49), 6),
+                                         round(rnd.uniform(10, 12), 6),
+                                         color=rnd.choice(['red', 'blue'])))
+        dmap.add_markers([rnd.uniform(47, 49) for _ in range(500)],
+                         [rnd.uniform(10, 12) for _ in range(500)], size='tiny')
+        for i in range(2000):
+            dmap.add_path_latlon(48 + math.sin(i / 100.0) + rnd.random() * 0.01,
+                                 11 + math.cos(i / 90.0) + rnd.random() * 0.01)
+        self.assertRaises(ValueError, dmap.generate_url)
+
+        shards = dmap.shard()
+        self.assertTrue(len(shards) > 1)
+        for url in dmap.generate_urls():
+            self.assertTrue(len(url) <= DecoratedMap.MAX_URL_LEN)
+        self.assertEqual(len(set((shard.center, shard.zoom) for shard in shards)), 1)
+        self.assertEqual(shards[0].zoom, 8)
+        self.assertEqual(sum(len(shard.markers) for shard in shards), 301)
+        self.assertEqual(sum(len(shard._marker_set) for shard in shards), 500)
+        pieces = [shard.path for shard in shards if len(shard.path)]
+        self.assertEqual(sum(len(piece) for piece in pieces), 2000 + len(pieces) - 1)
+        for piece, following in zip(pieces, pieces[1:]):
+            self.assertEqual(piece[-1], following[0])
+        self.assertEqual(len(dmap.markers), 301)
+
+        dmap.add_marker(AddressMarker('Munich'))
+        self.assertRaises(ValueError, dmap.shard)
+        dmap.center = '48,11'
+        dmap.zoom = 9
+        self.assertEqual(sum(len(shard.markers) for shard in dmap.shard()), 302)
+
+        # pieces are sized by their simplified encoding, and markers fill
+        # the room the path leaves
+        dmap = DecoratedMap(size_x=640, size_y=640, key='abc')
+        for i in range(4000):
+            dmap.add_path_latlon(48 + i * 1e-4 + rnd.uniform(-1e-6, 1e-6), 11 + i * 1e-4)
+        for _ in range(450):
+            dmap.add_marker(LatLonMarker(round(rnd.uniform(48, 48.4), 5),
+                                         round(rnd.uniform(11, 11.4), 5), color='red'))
+        shards = dmap.shard()
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(len(shards[0].path), 4000)
+        for url in dmap.generate_urls():
+            self.assertTrue(len(url) <= DecoratedMap.MAX_URL_LEN)
+
+        # a given center is kept and the zoom fitted around it
+        dmap.center = '47.7,10.7'
+        shards = dmap.shard()
+        self.assertEqual(shards[0].center, '47.7,10.7')
+        zoom = shards[0].zoom
+        cx, cy = mercator.to_pixels(47.7, 10.7, zoom)
+        for lat, lon in ((48.4, 11.4), (48.0, 11.0)):
+            x, y = mercator.to_pixels(lat, lon, zoom)
+            self.assertTrue(abs(x - cx) <= 320 and abs(y - cy) <= 320)
+        dmap.center = 'Munich'
+        self.assertRaises(ValueError, dmap.shard)
+
+    def test_auto_fit(self):
+        from motionless import mercator
+        import random
+        rnd = random.Random(5)
+        lats = [rnd.uniform(47, 49) for _ in range(1000)]
+        lons = [rnd.uniform(10, 12) for _ in range(1000)]
+        lat, lon, zoom = mercator.fit_viewport(lats, lons, 640, 640, padding=20)
+        self.assertEqual(zoom, 8)
+        for x, y in (mercator.to_pixels(max(lats), min(lons), zoom),
+                     mercator.to_pixels(min(lats), max(lons), zoom)):
+            cx, cy = mercator.to_pixels(lat, lon, zoom)
+            self.assertTrue(abs(x - cx) <= 300 and abs(y - cy) <= 300)
+        if numpy is not None:
+            self.assertEqual(mercator.fit_viewport(numpy.array(lats), numpy.array(lons),
+                                                   640, 640, padding=20),
+                             (lat, lon, zoom))
+        self.assertRaises(ValueError, mercator.fit_viewport, [], [], 640, 640)
+
+        vmap = VisibleMap(auto_fit=True)
+        vmap.add_latlon(48.1, 11.5)
+        vmap.add_latlon(48.2, 11.7)
+        self.assertEqual(
+            vmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&'
+            'center=48.15002%2C11.6&zoom=11&language=en')
+        vmap.add_address('Munich')
+        self.assertTrue('&visible=48.1%2C11.5%7C48.2%2C11.7%7CMunich&' in vmap.generate_url())
+
+        dmap = DecoratedMap(auto_fit=True)
+        dmap.add_marker(LatLonMarker(48.1, 11.5))
+        dmap.add_markers([48.3], [11.6])
+        dmap.add_path_latlon(48.0, 11.4)
+        dmap.add_path_latlon(48.05, 11.45)
+        self.assertEqual(
+            dmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&language=en&'
+            'center=48.1502%2C11.5&zoom=10&markers=%7C48.1%2C11.5%7C48.3%2C11.6&'
+            'path=enc%3A__~cH_qqdAowHowH')
+        self.assertTrue(dmap.estimated_length() >= len(dmap.generate_url()))
+        dmap.zoom = 5
+        self.assertTrue('&center=48.15%2C11.5&zoom=5&' in dmap.generate_url())
+        dmap.center = '48,11'
+        self.assertTrue('&center=48%2C11&zoom=5&' in dmap.generate_url())
+
+        # a zoom closer than FIT_MAX_ZOOM writes the center with more places
+        dmap = DecoratedMap(auto_fit=True, zoom=21)
+        dmap.add_markers([-84.123456789, -84.123456788], [-178.123456789, -178.123456787])
+        self.assertTrue(dmap.estimated_length() >= len(dmap.generate_url()))
+
+    def test_generate_url_is_cached_until_changed(self):
+        dmap = DecoratedMap()
+        dmap.add_marker(LatLonMarker(27.988056, 86.925278, label='S'))
+        url = dmap.generate_url()
+        self.assertTrue(str(dmap) is url)
+
+        dmap.add_marker(LatLonMarker(28.007222, 86.859444, label='B'))
+        self.assertTrue('label%3AB' in dmap.generate_url())
+        dmap.zoom = 12
+        self.assertTrue('&zoom=12&' in dmap.generate_url())
+
+        vmap = VisibleMap()
+        vmap.add_address('Tahoe City, CA')
+        first = vmap.generate_url()
+        vmap.add_address('Truckee, CA')
+        self.assertNotEqual(vmap.generate_url(), first)
+
+    def test_bulk_path_matches_single_points(self):
+        track = _wiggly_track(500)
+        lats = array('d', [lat for _, lat in track])
+        lons = array('d', [lng for lng, _ in track])
+        single = DecoratedMap()
+        for lat, lon in zip(lats, lons):
+            single.add_path_latlon(lat, lon)
+        bulk = DecoratedMap()
+        bulk.add_path_latlons(lats, lons)
+        self.assertEqual(bulk.generate_url(), single.generate_url())
+
+        interleaved = array('d')
+        for lat, lon in zip(lats, lons):
+            interleaved.extend((lat, lon))
+        buffered = DecoratedMap()
+        buffered.add_path_buffer(interleaved.tobytes())
+        self.assertEqual(buffered.generate_url(), single.generate_url())
+
+    def test_address_path(self):
+        dmap = DecoratedMap(pathcolor='red')
+        dmap.add_path_address('Sugarbowl, Truckee, CA')
+        dmap.add_path_address('Tahoe City, CA')
+        self.assertEqual(
+            dmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&language=en&'
+            'path=color%3Ared%7CSugarbowl%2C%20Truckee%2C%20CA%7C'
+            'Tahoe%20City%2C%20CA')
+
+    def test_escape_matches_quote(self):
+        from motionless import _escape, quote
+        for text in ('roadmap', 'color:0xff0000|1.5,-2', 'a b&c=d/e%20~f',
+                     '"<>#?[]{}^`\\\'!*()+;@$', u'M\xfcnchen|Z\xfcrich', u'東京'):
+            self.assertEqual(_escape(text), quote(text, safe='/&=%'))
+
+        dmap = DecoratedMap()
+        dmap.add_marker(AddressMarker(u'K\xf6ln, Dom', label='K'))
+        dmap.add_marker(LatLonMarker(1, 2, icon_url='http://x.org/a b.png'))
+        self.assertEqual(
+            dmap.generate_url(),
+            'https://maps.googleapis.com/maps/api/staticmap?maptype=roadmap&'
+            'format=png&scale=1&size=400x400&sensor=false&language=en&'
+            'markers=%7Clabel%3AK%7CK%C3%B6ln%2C%20Dom&'
+            'markers=%7Cicon%3Ahttp%3A//x.org/a%20b.png%7C1%2C2')
+
+    def test_url_signer(self):
+        secret = 'bbXgwW0k3631Bl2V5Z34gs9vYgf='
+        signer = UrlSigner(secret)
+        cmap = CenterMap(lat=48.858278, lon=2.294489, maptype='satellite',
+                         clientid='gme-exampleid', secret=signer)
+        self.assertTrue(cmap.generate_url().endswith(
+            '&signature=PsD-OrvyjeIflTpH1p6v5hElJrE='))
+        self.assertTrue(UrlSigner.for_secret(secret) is UrlSigner.for_secret(secret))
+        shared = UrlSigner.for_secret(secret)
+        for i in range(100):
+            UrlSigner.for_secret(base64.urlsafe_b64encode(b'secret %d' % i))
+        self.assertEqual(len(UrlSigner._cache), UrlSigner._cache_size)
+        self.assertFalse(UrlSigner.for_secret(secret) is shared)
+
+        urls = ['/maps/api/staticmap?center=%s,%s&client=gme-exampleid' % (i, i)
+                for i in range(5)]
+        self.assertEqual(list(signer.sign_many(urls)),
+                         [UrlSigner(secret).sign(url) for url in urls])
+
+    def test_map_template(self):
+        styles = [{'feature': 'road.highway', 'rules': {'color': '#c280e9'}}]
+        template = MapTemplate(DecoratedMap(size_x=200, size_y=150, style=styles,
+                                            clientid='gme-exampleid',
+                                            secret='bbXgwW0k3631Bl2V5Z34gs9vYgf='))
+        for lat, lon in ((37.422782, -122.085099), (48.858278, 2.294489)):
+            marker = LatLonMarker(lat, lon, label='G')
+            dmap = DecoratedMap(size_x=200, size_y=150, style=styles,
+                                clientid='gme-exampleid',
+                                secret='bbXgwW0k3631Bl2V5Z34gs9vYgf=')
+            dmap.add_marker(marker)
+            dmap.add_path_latlon(lat, lon)
+            dmap.add_path_latlon(lat + 0.01, lon)
+            self.assertEqual(
+                template.generate_url(markers=[marker],
+                                      path=[(lat, lon), (lat + 0.01, lon)]),
+                dmap.generate_url())
+
+        template = MapTemplate(CenterMap(maptype='satellite', key='abcdefghi'))
+        self.assertEqual(
+            template.generate_url(lat=48.858278, lon=2.294489),
+            CenterMap(lat=48.858278, lon=2.294489, maptype='satellite',
+                      key='abcdefghi').generate_url())
+
+        template = MapTemplate(VisibleMap(maptype='terrain'))
+        vmap = VisibleMap(maptype='terrain')
+        vmap.add_address('Sugarbowl, Truckee, CA')
+        vmap.add_address('Tahoe City, CA')
+        self.assertEqual(
+            template.generate_url(locations=['Sugarbowl, Truckee, CA', 'Tahoe City, CA']),
+            vmap.generate_url())
+
+    def test_bulk_generate_urls(self):
+        import io
+        import os
+        import tempfile
+        from motionless import bulk
+        lines = io.StringIO(
+            '{"id": 1, "markers": [{"lat": 37.422782, "lon": -122.085099, "label": "G"}]}\n'
+            '\n'
+            '{"id": 2, "markers": [{"address": "Tahoe City, CA"}], "path": [[1, 2], [3, 4]]}\n')
+        records = list(bulk.read_records(lines))
+        expected = []
+        for record in records:
+            dmap = DecoratedMap(key='abcdefghi')
+            for marker in record['markers']:
+                if 'address' in marker:
+                    dmap.add_marker(AddressMarker(marker['address']))
+                else:
+                    dmap.add_marker(LatLonMarker(marker['lat'], marker['lon'], label='G'))
+            for lat, lon in record.get('path', []):
+                dmap.add_path_latlon(lat, lon)
+            expected.append((record['id'], dmap.generate_url()))
+        self.assertEqual(list(bulk.generate_urls(records, key='abcdefghi')), expected)
+        self.assertEqual(
+            list(bulk.generate_urls(records, workers=2, chunk_size=1, key='abcdefghi')),
+            expected)
+
+        # lat and lon of a JSON record are the center; a path alone will do
+        lines = io.StringIO('{"lat": 48.1, "lon": 11.5, "path": [[48, 11], [48.1, 11.1]]}\n'
+                            '{"path": [[48, 11], [48.1, 11.1]]}\n')
+        urls = []
+        for center in ('48.1,11.5', None):
+            dmap = DecoratedMap(key='abcdefghi')
+            dmap.center = center
+            dmap.add_path_latlon(48, 11)
+            dmap.add_path_latlon(48.1, 11.1)
+            urls.append((None, dmap.generate_url()))
+        self.assertEqual(list(bulk.generate_urls(bulk.read_records(lines), key='abcdefghi')),
+                         urls)
+        self.assertTrue('&center=48.1%2C11.5&' in urls[0][1])
+
+        rows = io.StringIO('lat,lon\n48.858278,2.294489\n')
+        self.assertEqual(
+            list(bulk.generate_urls(bulk.read_records(rows, 'csv'), 'center',
+                                    maptype='satellite')),
+            [(None, 'https://maps.googleapis.com/maps/api/staticmap?maptype=satellite&'
+                    'format=png&scale=1&center=48.858278%2C2.294489&zoom=17&'
+                    'size=400x400&sensor=false&language=en')])
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            with open(path, 'w') as f:
+                f.write('id,lat,lon,color\nx,37.422782,-122.085099,red\ny,oops,,\n')
+            bulk.main([path, '-o', path + '.out', '--key', 'abcdefghi',
+                       '--size', '200x100', '--skip-invalid'])
+            with open(path + '.out') as f:
+                self.assertEqual(f.read().splitlines(), [
+                    'x\thttps://maps.googleapis.com/maps/api/staticmap?key=abcdefghi&'
+                    'maptype=roadmap&format=png&scale=1&size=200x100&sensor=false&'
+                    'language=en&markers=%7Ccolor%3Ared%7C37.422782%2C-122.085099',
+                    'y\t'])
+
+            secret = os.environ.pop('MOTIONLESS_SECRET', None)
+            try:
+                with self.assertRaises(SystemExit):
+                    bulk.main([path, '--clientid', 'gme-exampleid'])
+            finally:
+                if secret is not None:
+                    os.environ['MOTIONLESS_SECRET'] = secret
+        finally:
+            os.remove(path)
+            if os.path.exists(path + '.out'):
+                os.remove(path + '.out')
+
+    def test_bulk_generators_are_independent(self):
+        from motionless import bulk
+        records = [{'address': 'Paris'}, {'address': 'Rome'}]
+        satellite = bulk.generate_urls(records, 'center', maptype='satellite')
+        next(satellite)
+        terrain = bulk.generate_urls(records, 'center', maptype='terrain')
+        next(terrain)
+        self.assertTrue('maptype=satellite&' in next(satellite)[1])
+        self.assertTrue('maptype=terrain&' in next(terrain)[1])
+
+
+class TestGPolyEncoder(unittest.TestCase):
+    """
+    Unit tests for the polyline encoder
+    """
+
+    def test_invalid_engine(self):
+        self.assertRaises(ValueError, lambda: GPolyEncoder(engine='fortran'))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_engine_matches_python(self):
+        points = _wiggly_track(3000)
+        for threshold in (0, 0.00001, 0.0001):
+            self.assertEqual(
+                GPolyEncoder(threshold=threshold, engine='numpy').encode(points),
+                GPolyEncoder(threshold=threshold, engine='python').encode(points))
+
+    def test_hull_engine_matches_python(self):
+        zigzag = [(i * 1E-5, (-1) ** i * 1E-4 * 0.999 ** i) for i in range(600)]
+        walk = _wiggly_track(1000)
+        for points in (zigzag, walk, walk + walk[::-1]):
+            for threshold in (0, 0.000001, 0.0001):
+                self.assertEqual(
+                    GPolyEncoder(threshold=threshold, engine='hull').encode(points),
+                    GPolyEncoder(threshold=threshold, engine='python').encode(points))
+
+        # straight in decimal but not in binary: every distance is rounding
+        # noise, and the python engine's noise decides
+        import math
+        line = [(round(11.5 + i * 1E-5, 5), round(48.1 + i * 2E-5, 5)) for i in range(400)]
+        hull = GPolyEncoder(engine='hull')
+        farthest = hull._farthest_finder(line)
+        for first, last in ((0, 399), (13, 89), (26, 102), (100, 390)):
+            self.assertEqual(farthest(first, last), hull._farthest(line, first, last))
+        spiral = [(i * 1E-6 * math.cos(i / 10.0), i * 1E-6 * math.sin(i / 10.0))
+                  for i in range(1500)]
+        for points in (line, spiral):
+            self.assertEqual(GPolyEncoder(threshold=0, engine='hull').encode(points),
+                             GPolyEncoder(threshold=0, engine='python').encode(points))
+
+    def test_visvalingam(self):
+        points = _wiggly_track(2000)
+        for max_points in (2, 10, 500):
+            decoded = _decode(GPolyEncoder(max_points=max_points).encode(points)['points'])
+            self.assertEqual(len(decoded), max_points)
+        kept = GPolyEncoder(min_area=1e-9).visvalingam(points)
+        self.assertTrue(0 < len(kept) < len(points))
+        self.assertTrue(min(kept.values()) >= 1e-9)
+
+        dmap = DecoratedMap(simplify_max_points=25)
+        for lng, lat in points:
+            dmap.add_path_latlon(lat, lng)
+        self.assertEqual(len(_decode(dmap._polyencode())), 25)
+
+    def test_encode_without_levels(self):
+        points = _wiggly_track(500)
+        encoder = GPolyEncoder(threshold=0)
+        full = encoder.encode(points)
+        bare = encoder.encode(points, levels=False)
+        self.assertEqual(bare['points'], full['points'])
+        self.assertEqual(bare['levels'], None)
+        self.assertEqual(len(_decode(full['points'])), len(points))
+        self.assertEqual(full['points'][:10], 'yoqdHwaeeA')
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_encoding_matches_python(self):
+        from motionless import gpolyencode
+        points = _wiggly_track(500) + [(-179.99999, -89.99999), (179.99999, 89.99999)]
+        kept = list(range(len(points)))
+        vectorized = gpolyencode._encode_points_numpy(points, kept, 0, 0)
+        gpolyencode.numpy = None
+        try:
+            self.assertEqual(gpolyencode._encode_points(points, kept, 0, 0), vectorized)
+        finally:
+            gpolyencode.numpy = numpy
+
+    def test_encode_many(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from motionless.gpolyencode import Coordinates
+        paths = [_wiggly_track(n, seed=n) for n in (0, 1, 2, 40, 300, 7)]
+        encoder = GPolyEncoder()
+        expected = [encoder.encode(points) for points in paths]
+        self.assertEqual(encoder.encode_many(paths), expected)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(encoder.encode_many(paths, executor=executor), expected)
+
+        xs = array('d', [x for points in paths for x, _ in points])
+        ys = array('d', [y for points in paths for _, y in points])
+        offsets = [0]
+        for points in paths:
+            offsets.append(offsets[-1] + len(points))
+        self.assertEqual(
+            encoder.encode_many(Coordinates(xs, ys), offsets=offsets), expected)
+
+    def test_encode_significant_matches_encode(self):
+        points = _wiggly_track(2000)
+        for threshold in (0, 0.00001, 0.0001):
+            encoder = GPolyEncoder(threshold=threshold)
+            significance = encoder.significance(points)
+            self.assertEqual(
+                encoder.encode_significant(points, significance, threshold)['points'],
+                encoder.encode(points)['points'])
+
+    def test_incremental_encoder(self):
+        points = _wiggly_track(1000)
+        whole = IncrementalEncoder(window=len(points))
+        whole.extend(points)
+        self.assertEqual(whole.points, GPolyEncoder().encode(points)['points'])
+
+        windowed = IncrementalEncoder(window=50)
+        emitted = ''.join([windowed.append(point) for point in points])
+        self.assertEqual(emitted, windowed.committed)
+        self.assertTrue(windowed.points.startswith(windowed.committed))
+
+    def test_incremental_decorated_map(self):
+        points = _wiggly_track(300)
+        live = DecoratedMap(incremental_window=64)
+        replay = IncrementalEncoder(threshold=live.simplify_threshold, window=64)
+        for i, (lng, lat) in enumerate(points):
+            live.add_path_latlon(lat, lng)
+            replay.append((lng, lat))
+            if i % 25 == 0:
+                live.generate_url()
+        self.assertEqual(live._polyencode(), replay.points)
+
+    def test_incremental_path_replaced(self):
+        from motionless import Path
+        first = _wiggly_track(40, seed=1)
+        second = _wiggly_track(40, seed=2)
+        live = DecoratedMap(incremental_window=16)
+        for lng, lat in first:
+            live.add_path_latlon(lat, lng)
+        live.generate_url()
+        live.path = Path()
+        fresh = DecoratedMap(incremental_window=16)
+        for lng, lat in second:
+            live.add_path_latlon(lat, lng)
+            fresh.add_path_latlon(lat, lng)
+        self.assertEqual(live.generate_url(), fresh.generate_url())
+
+    def test_incremental_settings_changed(self):
+        points = _wiggly_track(300)
+        live = DecoratedMap(incremental_window=64)
+        for lng, lat in points:
+            live.add_path_latlon(lat, lng)
+        live.generate_url()
+
+        live.simplify_threshold = 1E-4
+        replay = IncrementalEncoder(threshold=1E-4, window=64)
+        replay.extend(points)
+        self.assertEqual(live._polyencode(), replay.points)
+
+        live.incremental_window = 16
+        replay = IncrementalEncoder(threshold=1E-4, window=16)
+        replay.extend(points)
+        self.assertEqual(live._polyencode(), replay.points)
+
+    def test_iterencode(self):
+        points = _wiggly_track(1000)
+        encoder = GPolyEncoder(threshold=0.0001)
+        self.assertEqual(''.join(encoder.iterencode(iter(points), window=2000)),
+                         encoder.encode(points)['points'])
+
+        # every input point stays within threshold of the streamed line
+        # (plus the 1e-5 rounding of the encoding itself)
+        decoded = _decode(''.join(encoder.iterencode(iter(points), window=40)))
+        self.assertTrue(len(decoded) < len(points))
+        for point in points:
+            self.assertTrue(
+                min(encoder._distance(point, decoded[k], decoded[k + 1])
+                    for k in range(len(decoded) - 1)) <= 0.0001 + 0.00003)
+
+    def test_iterencode_retains_nothing(self):
+        points = _wiggly_track(3000)
+        stream = GPolyEncoder(threshold=0.0001).iterencode(iter(points), window=40)
+        pieces = [next(stream) for _ in range(10)]
+        self.assertTrue(sum(len(piece) for piece in pieces) > 0)
+        self.assertEqual(stream.gi_frame.f_locals['encoder']._committed, [])
+
+        retained = IncrementalEncoder(threshold=0.0001, window=40)
+        streamed = IncrementalEncoder(threshold=0.0001, window=40, retain=False)
+        self.assertEqual(retained.extend(points) + retained.finish(),
+                         streamed.extend(points) + streamed.finish())
+        self.assertEqual(streamed.committed, '')
+        self.assertEqual(len(streamed._tail), 1)
+
+    def test_parallel_matches_sequential(self):
+        from motionless import gpolyencode
+        points = _wiggly_track(3000)
+        saved = gpolyencode._PARALLEL_MIN_POINTS, gpolyencode._PARALLEL_MIN_SPAN
+        gpolyencode._PARALLEL_MIN_POINTS, gpolyencode._PARALLEL_MIN_SPAN = 1000, 100
+        try:
+            parallel = GPolyEncoder(workers=2)
+            self.assertEqual(parallel.encode(points), GPolyEncoder().encode(points))
+            self.assertEqual(parallel.significance(points),
+                             GPolyEncoder().significance(points))
+            # spans of coordinate columns, as DecoratedMap paths are kept
+            columns = gpolyencode.Coordinates(array('d', [p[0] for p in points]),
+                                              memoryview(array('d', [p[1] for p in points])))
+            for engine in gpolyencode.ENGINES:
+                if engine == 'auto' or (engine == 'numpy' and numpy is None):
+                    continue
+                self.assertEqual(
+                    GPolyEncoder(workers=2, engine=engine).encode(columns),
+                    GPolyEncoder(engine=engine).encode(points))
+        finally:
+            gpolyencode._PARALLEL_MIN_POINTS, gpolyencode._PARALLEL_MIN_SPAN = saved
+
+
+class TestFetcher(unittest.TestCase):
+    """
+    Tests for the image fetcher, against a local stand-in server
+    """
+
+    def setUp(self):
+        import threading
+        try:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        except ImportError:
+            self.skipTest("needs Python 3")
+        test = self
+        self.requests = []
+        self.connections = set()
+        self.failures = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                test.requests.append(self.path)
+                test.connections.add(self.client_address)
+                if test.failures.get(self.path):
+                    test.failures[self.path] -= 1
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.send_header('Retry-After', '0')
+                    self.end_headers()
+                    return
+                body = ('image for %s' % self.path).encode('ascii')
+                self.send_response(200)
+                if 'truncated' in self.path:
+                    # promise more than is sent, then hang up
+                    self.send_header('Content-Length', str(2 * len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    self.close_connection = True
+                elif 'chunked' in self.path:
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for i in range(0, len(body), 5):
+                        piece = body[i:i + 5]
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+                    self.wfile.write(b'0\r\n\r\n')
+                else:
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _map(self, lat):
+        cmap = CenterMap(lat=lat, lon=2.294489)
+        cmap.base_url = self.base_url
+        return cmap
+
+    def test_fetch_all_reuses_connections(self):
+        from motionless.fetch import download
+        maps = [self._map(48 + i / 10.0) for i in range(6)]
+        self.failures[maps[2].generate_url()[len(self.base_url):]] = 2
+        images = download(maps, concurrency=2, backoff=0)
+        self.assertEqual(images, [('image for %s' % m.generate_url()[len(self.base_url):])
+                                  .encode('ascii') for m in maps])
+        self.assertEqual(len(self.requests), 8)
+        self.assertTrue(len(self.connections) <= 2)
+
+    def test_fetch_to_disk(self):
+        import asyncio
+        import os
+        import shutil
+        import tempfile
+        from motionless.fetch import Fetcher, FetchError, download
+        directory = tempfile.mkdtemp()
+        try:
+            url = self.base_url + '/chunked?x=1'
+            paths = download([url, self._map(1.5)], directory, backoff=0)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(os.path.basename(p) for p in paths))
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(f.read(), b'image for /chunked?x=1')
+            # the files are as readable as any other the process writes
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(paths[0]).st_mode & 0o777, 0o666 & ~umask)
+
+            async def fetch_failing():
+                async with Fetcher(retries=1, backoff=0) as fetcher:
+                    return await fetcher.fetch(self.base_url + '/down')
+            self.failures['/down'] = 5
+            with self.assertRaises(FetchError) as cm:
+                asyncio.run(fetch_failing())
+            self.assertEqual(cm.exception.status, 503)
+
+            # a body cut short leaves nothing behind
+            truncated = self.base_url + '/truncated'
+            with self.assertRaises(FetchError):
+                download([truncated, truncated], directory, retries=1, backoff=0)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(os.path.basename(p) for p in paths))
+            self.assertEqual(self.failures['/down'], 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_image_cache(self):
+        import os
+        import shutil
+        import tempfile
+        import time
+        from motionless.cache import ImageCache
+        from motionless.fetch import download
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ImageCache(directory, max_bytes=100, ttl=60)
+            cmap = self._map(48.5)
+            signed = cmap.generate_url() + '&signature=abc'
+            cache.put(signed, b'x' * 40)
+            self.assertEqual(cache.get(cmap.generate_url() + '&signature=xyz'), b'x' * 40)
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(cache.path(signed)).st_mode & 0o777, 0o666 & ~umask)
+
+            # least recently read entries go first
+            cache.put('a', b'a' * 40)
+            old = time.time() - 30
+            os.utime(cache.path('a'), (old, old))
+            cache.put('b', b'b' * 40)
+            self.assertEqual(cache.get('a'), None)
+            self.assertEqual(cache.get('b'), b'b' * 40)
+
+            # expired entries are misses
+            os.utime(cache.path('b'), (old, old - 60))
+            self.assertEqual(cache.get('b'), None)
+            self.assertFalse(os.path.exists(cache.path('b')))
+
+            cache.clear()
+            cache = ImageCache(directory, max_bytes=1000)
+            scans = []
+            stats = cache._stats
+            cache._stats = lambda: scans.append(1) or stats()
+            for i in range(300):
+                cache.put(str(i), b'x' * 10)
+            # each eviction frees a tenth of max_bytes before the next one
+            self.assertTrue(len(scans) <= 1 + 300 // 10)
+            self.assertTrue(cache._size <= 1000)
+
+            cache.clear()
+            cache = ImageCache(directory)
+            maps = [self._map(48 + i / 10.0) for i in range(3)]
+            images = download(maps, cache=cache)
+            self.assertEqual(len(self.requests), 3)
+            self.assertEqual(download(maps, cache=cache), images)
+            paths = download(maps, os.path.join(directory, 'images'), cache=cache)
+            self.assertEqual(len(self.requests), 3)
+            with open(paths[1], 'rb') as f:
+                self.assertEqual(f.read(), images[1])
+            self.assertEqual(os.stat(paths[1]).st_mode & 0o777, 0o666 & ~umask)
+        finally:
+            shutil.rmtree(directory)
+
 if __name__ == "__main__":
     unittest.main()